@@ -2,8 +2,22 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-from data_loader import download_data, preprocess_df, extract_last_date_updated, get_date_range
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from data_loader import (get_date_range, build_filter_index, filter_mask, build_search_index, search_mask,
+                         load_change_history, load_changes,
+                         list_releases, query_archive, make_read_only)
 import artist
+from timeseries import build_capacity_index, date_bounds, capacity_between, capacity_by, cumulative_series
+from refresher import RegisterRefresher
+from table_view import build_sort_index, query_table
+from figure_cache import FigureCache, figure_key, render_figure_json
+from warmstart import install_bundle, seed_figure_cache
+import metrics
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 
 
@@ -21,25 +35,126 @@ st.set_page_config(
 )
 
 
-# Fetch data
-@st.cache_data
-def load_data():
-    return preprocess_df(download_data())
-
-raw_data = load_data()
+# Tag everything timed during this rerun with the session it belongs to
+rerun_started = time.perf_counter()
+session_id = get_script_run_ctx().session_id
+rerun_number = metrics.begin_rerun(session_id)
+# Drop the rerun counts of sessions whose browser tab has gone
+if runtime.exists():
+    metrics.prune_sessions(lambda session: session == session_id or runtime.get_instance().is_active_session(session))
+
+
+# Warm-start bundle built at deploy time, so a new replica serves its first page without waiting on the portal
+WARMSTART = os.environ.get("TEC_WARMSTART", "warmstart")
+
+# Fetch data: one background refresher per process polls the portal, page renders read its snapshot
+@st.cache_resource
+def get_refresher():
+    manifest = install_bundle(WARMSTART)
+    refresher = RegisterRefresher.from_env(**({'last_updated': manifest['last_updated']} if manifest else {}))
+    refresher.start()
+    return refresher
+
+
+# The indexes below are built once per dataset version and reused across reruns and
+# sessions: they are cached on `version`, as hashing the frame itself (`_df`, `_cube`)
+# on every rerun would cost about as much as a scan.
+
+# Filter bitmasks of the register rows
+@st.cache_resource(max_entries=4)
+def load_filter_index(_df, version):
+    return build_filter_index(_df)
+
+# Filter index of the aggregation cube every chart and KPI card is rolled up from
+@st.cache_resource(max_entries=4)
+def load_cube_index(_cube, version):
+    return build_filter_index(_cube)
+
+# Past releases from the archive, for the release selector
+@st.cache_resource(max_entries=4)
+def load_archived_release(release):
+    data = query_archive(release=release).drop(columns=['Release', 'Release Date'])
+    return make_read_only(data), make_read_only(artist.build_cube(data))
+
+@st.cache_data(ttl=600)
+def load_release_labels():
+    # Newest first; releases are keyed by content hash, as several can share a date
+    releases = list_releases().iloc[::-1]
+    return dict(zip(releases['sha256'], releases['release_date'] + ' (' + releases['sha256'].str[:8] + ')'))
+
+@st.cache_resource(max_entries=4)
+def load_release_changes(version):
+    return load_changes(version)
+
+# Inverted/trigram index of the free-text columns for the search box
+@st.cache_resource(max_entries=4)
+def load_search_index(_df, version):
+    return build_search_index(_df)
+
+# Sorted per-group prefix sums of capacity by connection date, for the cumulative chart and KPIs
+@st.cache_resource(max_entries=4)
+def load_capacity_index(_cube, version):
+    return build_capacity_index(_cube)
+
+# Row order of every column for the paginated table
+@st.cache_resource(max_entries=4)
+def load_sort_index(_df, version):
+    return build_sort_index(_df)
+
+# Worker pool the charts are built on concurrently, shared by every session
+@st.cache_resource
+def get_render_pool():
+    return ThreadPoolExecutor(max_workers=int(os.environ.get("TEC_RENDER_WORKERS", 4)),
+                              thread_name_prefix="tec-render")
+
+# Serialized figures shared by every session, keyed by dataset version, filters and chart
+@st.cache_resource
+def get_figure_cache():
+    cache = FigureCache(maxsize=int(os.environ.get("TEC_FIGURE_CACHE_SIZE", 256)))
+    seed_figure_cache(cache, WARMSTART)
+    return cache
+
+# Prometheus / JSON lines endpoint for the whole process, when TEC_METRICS_PORT is set
+@st.cache_resource
+def start_metrics_server():
+    port = os.environ.get("TEC_METRICS_PORT")
+    return metrics.serve(int(port)) if port else None
+
+start_metrics_server()
+refresher = get_refresher()
+if not refresher.wait_ready(timeout=60):
+    st.error("The TEC register could not be loaded from the NESO data portal. Please try again later.")
+    st.stop()
+
+register = refresher.snapshot
+release_labels = load_release_labels()
+release = st.sidebar.selectbox('Register release', ['Latest', *release_labels],
+                               format_func=lambda release: release_labels.get(release, release))
+if release == 'Latest':
+    raw_data, data_version, cube = register.data, register.version, register.cube
+    last_updated = register.last_updated
+else:
+    raw_data, cube = load_archived_release(release)
+    data_version, last_updated = f'archive:{release}', f'archived release of {release_labels[release]}'
+filter_index = load_filter_index(raw_data, data_version)
+cube_index = load_cube_index(cube, data_version)
 
 # set page title
-st.title(f":bulb: NESO Transmission Entry Capacity Register Dashboard: {get_date_range(raw_data)}\nData Last Updated: {extract_last_date_updated()}")
+st.title(f":bulb: NESO Transmission Entry Capacity Register Dashboard: {get_date_range(raw_data)}\nData Last Updated: {last_updated}")
 
 
 
 
 # +++++++++++++++++++++++++++++++ SIDE BAR FILTERS and DATA +++++++++++++++++++++++++++++++++++
+search_query = st.sidebar.text_input('Search projects', placeholder='Project, customer, site or ID')
+search_fuzzy = st.sidebar.checkbox('Match misspellings', value=True)
+
 def create_sidebar_filter(label, feature, placeholder):
+    options = filter_index['features'][feature]['options']
     return st.sidebar.multiselect(
                                 label=label,
-                                options=raw_data[feature].unique(),
-                                default=raw_data[feature].unique(),
+                                options=options,
+                                default=options,
                                 placeholder=placeholder)
 
 to_filter = create_sidebar_filter(label='Trasmission Owner',
@@ -53,9 +168,20 @@ agreement_filter = create_sidebar_filter(label='Agreement Type',
                                          placeholder='Choose Agreement Type')
 
 
-data = raw_data[raw_data['HOST TO'].isin(to_filter)
-                & raw_data['Project Status'].isin(project_status_filter)
-                & raw_data['Agreement Type'].isin(agreement_filter)]
+selections = {'HOST TO': to_filter,
+              'Project Status': project_status_filter,
+              'Agreement Type': agreement_filter}
+chart_selections = selections
+with metrics.stage('sidebar_filter') as filter_info:
+    row_mask = filter_mask(filter_index, selections)
+    if search_query.strip():
+        # The search narrows rows the cube cannot tell apart, so the charts' cube is rebuilt from the matches
+        row_mask &= search_mask(load_search_index(raw_data, data_version), search_query, fuzzy=search_fuzzy)
+        data_cube = artist.build_cube(raw_data[row_mask])
+        chart_selections = {**selections, 'Search': [search_query.strip().lower(), search_fuzzy]}
+    else:
+        data_cube = cube[filter_mask(cube_index, selections)]
+    filter_info['rows'] = int(row_mask.sum())
 
 
 # +++++++++++++++++++++++++++++++ CARDS ++++++++++++++++++++++++++++++++++++++
@@ -84,15 +210,16 @@ def format_MW_GW(capacity: float, feature: str, is_capacity=True):
          st.markdown(f"<h3 style='text-align: center;'>{capacity}</h3>", unsafe_allow_html=True)
 
 
+kpis = artist.summarise_kpis(data_cube)
 project_count_card, to_count_card, mw_change_card, connect_cap_card = st.columns(4)
 with project_count_card:
-    format_MW_GW(data.shape[0], 'Total Projects', False)
+    format_MW_GW(kpis['Total Projects'], 'Total Projects', False)
 with to_count_card:
-    format_MW_GW(data['HOST TO'].nunique(), 'Network Owners', False)
+    format_MW_GW(kpis['Network Owners'], 'Network Owners', False)
 with mw_change_card:
-    format_MW_GW(data['MW Change'].sum(), 'Capacity Change')
+    format_MW_GW(kpis['Capacity Change'], 'Capacity Change')
 with connect_cap_card:
-    format_MW_GW(data['Connection Cap (MW)'].sum(), 'Total Capacity')
+    format_MW_GW(kpis['Total Capacity'], 'Total Capacity')
 
 "---"
 
@@ -100,6 +227,25 @@ def add_sub_title(title: str, desciption: str=None):
     st.markdown(f"<h3 style='text-align: center;'>{title}</h3>", unsafe_allow_html=True)
     if desciption:
         st.markdown(desciption, unsafe_allow_html=True)
+
+
+figure_cache = get_figure_cache()
+chart_jobs, chart_slots = {}, {}
+
+def plot_chart(chart_id, plot_func):
+    """Reserve the chart's place on the page; render_charts() fills it once the figure is ready."""
+    chart_jobs[chart_id] = (figure_key(data_version, chart_selections, chart_id), lambda: plot_func(data_cube))
+    chart_slots[chart_id] = st.empty()
+
+
+def render_charts():
+    """Build the reserved charts on the worker pool, drawing each one as soon as it is ready."""
+    chart_timings = {}
+    for chart_id, spec, seconds in figure_cache.get_or_build_many(chart_jobs, get_render_pool()):
+        render_figure_json(chart_slots[chart_id], spec)
+        chart_timings[chart_id] = seconds
+        metrics.registry.record(f'chart:{chart_id}', seconds)
+    return chart_timings
     
     
 #                                        +++++++++++++++++++++++++++++++ ALL CHARTS +++++++++++++++++++++++++++++++++++
@@ -115,14 +261,14 @@ plant_type_description = "CCGT (Combined Cycle Gas Turbine) plants, including va
 
 
 add_sub_title('Connection Capacity by Plant Type and Network Owner', plant_type_description)
-st.plotly_chart(artist.plot_plant_type_cap(data), use_container_width=True)
+plot_chart('plant_type_cap', artist.plot_plant_type_cap)
 "---"
 
 
 # Sunburst Chart for Connection Capacity by Host TO, Plant Type, and Project Status
 sun_title = "Connection Capacity by Host TO, Plant Type, and Project Status"
 add_sub_title(sun_title)
-st.plotly_chart(artist.plot_sunburst(data), use_container_width=True)
+plot_chart('sunburst', artist.plot_sunburst)
 "---"
 
 
@@ -137,7 +283,7 @@ doughtnut_description = "The analysis of energy projects by connection capacity
                          (25 projects) under construction, the data suggests a pressing need to expedite \
                          projects through approvals and construction to meet future energy demands effectively."
 add_sub_title(doughtnut_title, doughtnut_description)
-st.plotly_chart(artist.plot_conn_capa_dist_by_status_host(data), use_container_width=True)
+plot_chart('status_host_dist', artist.plot_conn_capa_dist_by_status_host)
 "---"
 
 
@@ -152,15 +298,98 @@ line_description = "The dataset provides a comprehensive overview of energy proj
                     through 2028, reflecting robust plans to meet increasing energy demands and suggesting a strong commitment to enhancing \
                     and diversifying the energy landscape in the coming years."
 add_sub_title(line_title, line_description)
-st.plotly_chart(artist.plot_timelines(data), use_container_width=True)
+# Plain labels rather than format_func: AppTest (used by warmstart.py measure) looks the value up in the labels
+timeline_buckets = st.radio('Timeline buckets', [bucket.capitalize() for bucket in artist.TIMELINE_BUCKETS],
+                            horizontal=True).lower()
+plot_chart(f'timelines:{timeline_buckets}', partial(artist.plot_timelines, granularity=timeline_buckets))
+"---"
+
+
+# Cumulative connection capacity and the capacity connected within a window of connection dates
+cumulative_title = "Cumulative Connection Capacity"
+cumulative_description = "Running totals of contracted capacity by connection date, as planned against. \
+                          Pick a window of connection dates to see the capacity connected by its end and the \
+                          capacity added within it. Projects without a connection date are not counted."
+add_sub_title(cumulative_title, cumulative_description)
+if search_query.strip():
+    # The search narrows rows the shared index cannot tell apart, so the matches get an index of their own
+    capacity_index, capacity_selections = build_capacity_index(data_cube), None
+else:
+    capacity_index, capacity_selections = load_capacity_index(cube, data_version), selections
+
+if len(capacity_index['keys']):
+    first_date, last_date = date_bounds(capacity_index)
+    window_start = min(max(pd.Timestamp.today().normalize(), first_date), last_date)
+    window_end = min(window_start + pd.DateOffset(years=5), last_date)
+    window = st.date_input('Connection window', value=(window_start.date(), window_end.date()),
+                           min_value=first_date.date(), max_value=last_date.date())
+    if window:
+        # Mid-way through picking a range only its start is set
+        window_start, window_end = pd.Timestamp(window[0]), pd.Timestamp(window[-1])
+
+    connected = capacity_by(capacity_index, window_end, capacity_selections)
+    added = capacity_between(capacity_index, window_start, window_end, capacity_selections)
+    connected_card, added_card, projects_card = st.columns(3)
+    with connected_card:
+        format_MW_GW(connected['Connection Cap (MW)'], f"Connected by {window_end:%d %b %Y}")
+    with added_card:
+        format_MW_GW(added['Connection Cap (MW)'], f"Added {window_start:%d %b %Y} to {window_end:%d %b %Y}")
+    with projects_card:
+        format_MW_GW(added['Projects'], 'Projects Connecting in Window', False)
+
+    plot_chart('cumulative_capacity',
+               lambda _: artist.plot_cumulative_capacity(cumulative_series(capacity_index, selections=capacity_selections,
+                                                                           by='HOST TO')))
+else:
+    st.info('None of the selected projects has a connection date.')
 "---"
 
+chart_timings = render_charts()
+
+
+
+# +++++++++++++++++++++++++++++++ CHANGES SINCE LAST RELEASE +++++++++++++++++++++++++++++++++++
+
+release_changes = load_release_changes(data_version)
+if release_changes is not None:
+    with st.expander('What changed since the last release'):
+        history = {entry['release']: entry for entry in load_change_history()}
+        st.caption(f"Recorded {history[data_version]['recorded_at'][:16].replace('T', ' ')} UTC")
+        inserted_col, removed_col, updated_col = st.columns(3)
+        inserted_col.metric('New projects', len(release_changes['inserted']))
+        removed_col.metric('Removed projects', len(release_changes['removed']))
+        updated_col.metric('Updated projects', len(release_changes['updated_after']))
+        change_columns = ['Project Name', 'HOST TO', 'Plant Type', 'Project Status', 'Connection Cap (MW)', 'Connection Date']
+        st.dataframe(pd.concat({change.replace('_', ' ').capitalize(): release_changes[change][change_columns]
+                                for change in ['inserted', 'removed', 'updated_before', 'updated_after']})
+                       .droplevel(list(range(1, 4))),
+                     use_container_width=True)
+"---"
 
 
 # +++++++++++++++++++++++++++++++ ALL DATA and CELEBRATE +++++++++++++++++++++++++++++++++++
 
-st.write(f"Table Showing {data.shape[0]} Projects")
-st.dataframe(data)
+st.write(f"Table Showing {int(row_mask.sum())} Projects")
+
+# Only the visible page and columns are serialized and sent to the browser
+sort_col, order_col, size_col = st.columns([2, 1, 1])
+table_sort = sort_col.selectbox('Sort by', [None, *raw_data.columns],
+                                format_func=lambda col: 'Register order' if col is None else col)
+table_ascending = order_col.radio('Order', ['Ascending', 'Descending'], horizontal=True) == 'Ascending'
+table_page_size = size_col.selectbox('Rows per page', [25, 50, 100, 250], index=1)
+table_columns = st.multiselect('Columns', list(raw_data.columns), default=list(raw_data.columns))
+
+table_page = st.session_state.get('table_page', 1)
+page_df, table_rows, table_pages = query_table(raw_data, row_mask,
+                                               sort_index=load_sort_index(raw_data, data_version),
+                                               sort_by=table_sort, ascending=table_ascending,
+                                               columns=table_columns,
+                                               page=table_page, page_size=table_page_size)
+st.dataframe(page_df, use_container_width=True)
+if table_page > table_pages:
+    st.session_state['table_page'] = table_pages
+st.number_input(f'Page (of {table_pages}, {table_rows} matching rows)', min_value=1,
+                max_value=table_pages, key='table_page')
 # celebrate = lambda : st.balloons()
 left, middle, right = st.columns([1, 6, 1])
 
@@ -180,3 +409,38 @@ with right:
     
     if st.button('Celebrate'):
         st.balloons()
+
+metrics.end_rerun(time.perf_counter() - rerun_started)
+
+
+# +++++++++++++++++++++++++++++++ DEBUG PANEL (?debug=1 or TEC_DEBUG=1) +++++++++++++++++++++++++++++++++++
+
+if st.query_params.get('debug') == '1' or os.environ.get('TEC_DEBUG') == '1':
+    def stage_table(events):
+        if not events:
+            return pd.DataFrame()
+        events = pd.DataFrame(events)
+        return (events.groupby('stage')
+                      .agg(calls=('seconds', 'size'), seconds=('seconds', 'sum'), max_seconds=('seconds', 'max'),
+                           rows=('rows', 'last'), cache_hits=('cache', lambda c: int((c == 'hit').sum())),
+                           process_peak_rss_mb=('process_peak_rss_bytes', lambda b: b.max() / 2**20))
+                      .sort_values('seconds', ascending=False))
+
+    with st.sidebar.expander('Debug: this rerun'):
+        st.caption(f'Session {session_id[:8]}, rerun {rerun_number}. '
+                   'Peak memory is the whole process\'s high-water mark, shared by every session.')
+        st.dataframe(stage_table(metrics.registry.events(session_id, rerun_number)), use_container_width=True)
+
+    with st.sidebar.expander('Debug: this session'):
+        st.dataframe(stage_table(metrics.registry.events(session_id)), use_container_width=True)
+
+    with st.sidebar.expander('Debug: process'):
+        st.dataframe(pd.DataFrame(metrics.registry.stages()).T, use_container_width=True)
+        st.download_button('Prometheus metrics', metrics.registry.to_prometheus(), file_name='tec-metrics.prom')
+        st.download_button('Events (JSON lines)', metrics.registry.to_jsonl(), file_name='tec-metrics.jsonl')
+
+    with st.sidebar.expander('Debug: figure cache'):
+        st.json(figure_cache.stats())
+
+    with st.sidebar.expander('Debug: chart render timings'):
+        st.dataframe(pd.Series(chart_timings, name='Seconds').rename_axis('Chart'), use_container_width=True)
@@ -0,0 +1,297 @@
+"""
+Headless HTTP API over the TEC register aggregates.
+
+Serves the numbers behind the dashboard (KPI cards, capacity by plant type and
+HOST TO, the status/HOST TO doughnut splits and the timeline) and the raw rows,
+from the same refresher snapshot, cube and filter indexes the app uses:
+
+    GET /api/version
+    GET /api/kpis
+    GET /api/plant-type-capacity
+    GET /api/capacity-split?by=status|host_to
+    GET /api/timeline?granularity=day|month|quarter|financial year
+    GET /api/rows?columns=...&offset=0&limit=1000
+
+Every endpoint takes the sidebar filters as repeatable `host_to`, `status` and
+`agreement` parameters and `format=json` (default) or `format=csv`. Responses are
+cached per dataset version and filters, carry an ETag and answer If-None-Match
+with 304. JSON rows are paged, `ROWS_DEFAULT_LIMIT` at a time unless `limit` is
+given, up to `ROWS_MAX_LIMIT`; CSV rows are streamed in chunks rather than built
+in memory, and may be the whole register.
+
+    python api.py --port 8700
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+import artist
+import metrics
+from data_loader import build_filter_index, filter_mask
+from figure_cache import FigureCache
+from refresher import RegisterRefresher
+
+__all__ = ['TecApi', 'serve']
+
+# Query parameter of each sidebar filter
+FILTER_PARAMS = {"host_to": "HOST TO", "status": "Project Status", "agreement": "Agreement Type"}
+SPLITS = {"status": ("Project Status", "HOST TO"), "host_to": ("HOST TO", "Project Status")}
+CSV_CHUNK_ROWS = 5000
+# JSON rows are cached, so a page of them is bounded
+ROWS_DEFAULT_LIMIT = 1000
+ROWS_MAX_LIMIT = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class TecApi(ThreadingHTTPServer):
+    """
+    Threaded HTTP server answering the API from a RegisterRefresher's snapshots.
+
+    Parameters:
+
+        refresher (RegisterRefresher): Source of the current register snapshot.
+        port (int): Port to listen on, 0 for any free port.
+        host (str): Interface to listen on.
+        cache_size (int): Number of responses kept in the response cache.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, refresher, port=8700, host="0.0.0.0", cache_size=1024):
+        super().__init__((host, port), _ApiHandler)
+        self.refresher = refresher
+        self.responses = FigureCache(maxsize=cache_size, serialize=bytes, name="api_cache")
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def indexes(self, snapshot):
+        """Filter indexes of the snapshot's rows and cube, built once per dataset version."""
+        with self._lock:
+            indexes = self._indexes.get(snapshot.version)
+        if indexes is None:
+            indexes = (build_filter_index(snapshot.data), build_filter_index(snapshot.cube))
+            with self._lock:
+                # Only the current release is ever queried
+                self._indexes = {snapshot.version: indexes}
+        return indexes
+
+
+def _filters_key(selections):
+    # Independent of the order the parameters and their values were given in
+    return tuple(sorted((feature, tuple(sorted(values))) for feature, values in selections.items()))
+
+
+def _etag(key):
+    return '"' + hashlib.sha256(repr(key).encode()).hexdigest()[:32] + '"'
+
+
+def _records(df):
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+class _ApiHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        endpoints = {"/api/version": self._version,
+                     "/api/kpis": self._kpis,
+                     "/api/plant-type-capacity": self._plant_type_capacity,
+                     "/api/capacity-split": self._capacity_split,
+                     "/api/timeline": self._timeline,
+                     "/api/rows": self._rows}
+        try:
+            if url.path not in endpoints:
+                raise ApiError(404, f"Unknown endpoint {url.path}")
+            snapshot = self.server.refresher.snapshot
+            if snapshot is None:
+                raise ApiError(503, "The register has not been loaded yet")
+            with metrics.stage(f"api:{url.path}"):
+                endpoints[url.path](snapshot, params)
+        except ApiError as e:
+            self._send(e.status, json.dumps({"error": str(e)}).encode(), "application/json")
+        except Exception:
+            logger.exception("Failed to answer %s", self.path)
+            self._send(500, json.dumps({"error": "Internal server error"}).encode(), "application/json")
+
+    # ----------------------------------------------------------------- helpers
+
+    def _param(self, params, name, default=None, choices=None):
+        value = params.get(name, [default])[-1]
+        if choices is not None and value not in choices:
+            raise ApiError(400, f"{name} must be one of {', '.join(map(str, choices))}")
+        return value
+
+    def _int_param(self, params, name, default=None, minimum=None, maximum=None):
+        value = self._param(params, name, default)
+        try:
+            value = int(value) if value is not None else None
+        except ValueError:
+            raise ApiError(400, f"{name} must be an integer")
+        if value is not None and minimum is not None and value < minimum:
+            raise ApiError(400, f"{name} must be at least {minimum}")
+        if value is not None and maximum is not None and value > maximum:
+            raise ApiError(400, f"{name} must be at most {maximum}")
+        return value
+
+    def _selections(self, params):
+        return {feature: params[param] for param, feature in FILTER_PARAMS.items() if param in params}
+
+    def _filtered_cube(self, snapshot, selections):
+        _, cube_index = self.server.indexes(snapshot)
+        return snapshot.cube[filter_mask(cube_index, selections)]
+
+    def _respond(self, snapshot, params, endpoint, build, options=()):
+        """Answer from the response cache, building the body with `build(selections)` on a miss."""
+        fmt = self._param(params, "format", "json", ("json", "csv"))
+        selections = self._selections(params)
+        key = (snapshot.version, endpoint, _filters_key(selections), tuple(options), fmt)
+        etag = _etag(key)
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", headers={"ETag": etag})
+            return
+
+        def build_body():
+            result = build(selections)
+            if fmt == "csv":
+                return pd.DataFrame(result if isinstance(result, pd.DataFrame) else [result]).to_csv(index=False).encode()
+            if isinstance(result, pd.DataFrame):
+                result = _records(result)
+            return json.dumps({"version": snapshot.version, "filters": selections, "data": result}).encode()
+
+        body = self.server.responses.get_or_build(key, build_body)
+        content_type = "text/csv" if fmt == "csv" else "application/json"
+        self._send(200, body, content_type, {"ETag": etag})
+
+    def _send(self, status, body, content_type=None, headers=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # ----------------------------------------------------------------- endpoints
+
+    def _version(self, snapshot, params):
+        body = {"version": snapshot.version, "last_updated": snapshot.last_updated,
+                "refreshed_at": snapshot.refreshed_at, "rows": len(snapshot.data)}
+        self._send(200, json.dumps(body).encode(), "application/json")
+
+    def _kpis(self, snapshot, params):
+        def build(selections):
+            kpis = artist.summarise_kpis(self._filtered_cube(snapshot, selections))
+            return {name: int(value) if name in ("Total Projects", "Network Owners") else float(value)
+                    for name, value in kpis.items()}
+        self._respond(snapshot, params, "kpis", build)
+
+    def _plant_type_capacity(self, snapshot, params):
+        self._respond(snapshot, params, "plant-type-capacity",
+                      lambda selections: artist.plant_type_capacity(self._filtered_cube(snapshot, selections)))
+
+    def _capacity_split(self, snapshot, params):
+        by = self._param(params, "by", "status", SPLITS)
+        primary, secondary = SPLITS[by]
+        self._respond(snapshot, params, "capacity-split",
+                      lambda selections: artist.capacity_split(self._filtered_cube(snapshot, selections),
+                                                               primary, secondary),
+                      options=[by])
+
+    def _timeline(self, snapshot, params):
+        granularity = self._param(params, "granularity", "day", artist.TIMELINE_BUCKETS)
+        max_points = self._int_param(params, "max_points", 2000)
+
+        def build(selections):
+            series, _ = artist.timeline_series(self._filtered_cube(snapshot, selections), granularity, max_points)
+            return series.rename(columns={"Project Name": "Projects", "Plant Type": "Plant Types"})
+        self._respond(snapshot, params, "timeline", build, options=[granularity, max_points])
+
+    def _rows(self, snapshot, params):
+        columns = params.get("columns", [",".join(snapshot.data.columns)])[-1].split(",")
+        unknown = set(columns) - set(snapshot.data.columns)
+        if unknown:
+            raise ApiError(400, f"Unknown columns: {', '.join(sorted(unknown))}")
+        fmt = self._param(params, "format", "json", ("json", "csv"))
+        offset = self._int_param(params, "offset", 0, minimum=0)
+        if fmt == "json":
+            limit = self._int_param(params, "limit", ROWS_DEFAULT_LIMIT, minimum=0, maximum=ROWS_MAX_LIMIT)
+        else:
+            limit = self._int_param(params, "limit", minimum=0)
+
+        def select(selections):
+            row_index, _ = self.server.indexes(snapshot)
+            rows = snapshot.data[filter_mask(row_index, selections)]
+            end = offset + limit if limit is not None else None
+            return rows.iloc[offset:end][columns]
+
+        if fmt == "json":
+            self._respond(snapshot, params, "rows", select, options=[tuple(columns), offset, limit])
+            return
+
+        # CSV rows are streamed in chunks and not cached, as they can be the whole register
+        selections = self._selections(params)
+        etag = _etag((snapshot.version, "rows", _filters_key(selections), tuple(columns), offset, limit, "csv"))
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", headers={"ETag": etag})
+            return
+        rows = select(selections)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("ETag", etag)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for start in range(0, max(len(rows), 1), CSV_CHUNK_ROWS):
+            self.wfile.write(rows.iloc[start:start + CSV_CHUNK_ROWS].to_csv(index=False, header=not start).encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(refresher, port=8700, host="0.0.0.0", cache_size=1024):
+    """
+    Start a TecApi on a daemon thread.
+
+    Parameters:
+
+        refresher (RegisterRefresher): Source of the current register snapshot.
+        port (int): Port to listen on, 0 for any free port.
+        host (str): Interface to listen on.
+        cache_size (int): Number of responses kept in the response cache.
+
+    Returns:
+
+        TecApi: The running server. Call `shutdown()` to stop it.
+    """
+    server = TecApi(refresher, port=port, host=host, cache_size=cache_size)
+    threading.Thread(target=server.serve_forever, name="tec-api", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSON/CSV API over the TEC register aggregates.")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("TEC_API_PORT", 8700)))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    refresher = RegisterRefresher.from_env()
+    refresher.start()
+    refresher.wait_ready()
+    server = TecApi(refresher, port=args.port, host=args.host, cache_size=args.cache_size)
+    print(f"Serving the TEC API on http://{args.host}:{args.port}/api/")
+    server.serve_forever()
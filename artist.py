@@ -1,29 +1,143 @@
 
 
-import plotly.express as px
-from plotly.subplots import make_subplots
-import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
+import metrics
 
-__all__ = ['plot_project_stat_cap', 'plot_plant_type_cap',  'plot_sunburst', 'plot_timelines', 'plot_conn_capa_dist_by_status_host']
+__all__ = ['plot_project_stat_cap', 'plot_plant_type_cap',  'plot_sunburst', 'plot_timelines', 'plot_conn_capa_dist_by_status_host',
+           'build_cube', 'update_cube', 'summarise_kpis', 'plant_type_capacity', 'capacity_split', 'timeline_series',
+           'plot_cumulative_capacity']
+
+CUBE_KEYS = ["HOST TO", "Plant Type", "Project Status", "Agreement Type", "Connection Date"]
+
+
+@metrics.timed("build_cube")
+def build_cube(df: pd.DataFrame):
+    """
+    Pre-aggregate the register into the cube every chart and KPI card is rolled up from.
+
+    Parameters:
+    
+        df (pd.DataFrame): The preprocessed register.
+
+    Returns:
+    
+        pd.DataFrame: One row per (HOST TO, Plant Type, Project Status, Agreement Type,
+                      Connection Date) with summed 'Connection Cap (MW)' and 'MW Change'
+                      and the number of 'Projects'. Rows without a connection date are kept.
+    """
+    return (df.groupby(CUBE_KEYS, observed=True, dropna=False, sort=False)
+              .agg(**{'Connection Cap (MW)': ('Connection Cap (MW)', 'sum'),
+                      'MW Change': ('MW Change', 'sum'),
+                      'Projects': ('Connection Cap (MW)', 'size')})
+              .reset_index())
+
+
+@metrics.timed("update_cube")
+def update_cube(cube: pd.DataFrame, changes: dict):
+    """
+    Roll a release's change set into an existing cube instead of rebuilding it.
+
+    Parameters:
+    
+        cube (pd.DataFrame): The cube of the previous release, from build_cube.
+        changes (dict): The change set from data_loader.diff_releases.
+
+    Returns:
+    
+        pd.DataFrame: The cube of the new release.
+    """
+    added = [changes[change] for change in ('inserted', 'updated_after') if len(changes[change])]
+    dropped = [changes[change] for change in ('removed', 'updated_before') if len(changes[change])]
+    value_cols = ['Connection Cap (MW)', 'MW Change', 'Projects']
+
+    parts = [cube]
+    if added:
+        parts.append(build_cube(pd.concat(added)))
+    if dropped:
+        dropped_cube = build_cube(pd.concat(dropped))
+        dropped_cube[value_cols] = -dropped_cube[value_cols]
+        parts.append(dropped_cube)
+
+    category_cols = [col for col in CUBE_KEYS if isinstance(cube[col].dtype, pd.CategoricalDtype)]
+    merged = pd.concat([part.astype({col: object for col in category_cols}) for part in parts], ignore_index=True)
+    merged = (merged.groupby(CUBE_KEYS, dropna=False, sort=False)[value_cols].sum()
+                    .reset_index())
+    merged = merged[merged['Projects'] > 0].reset_index(drop=True)
+    return merged.astype({col: 'category' for col in category_cols})
+
+
+def _as_cube(df: pd.DataFrame):
+    # Charts accept either register rows or an already built (and sliced) cube
+    return df if 'Projects' in df.columns else build_cube(df)
+
+
+def summarise_kpis(df: pd.DataFrame):
+    """
+    Compute the headline KPI card values.
+
+    Parameters:
+    
+        df (pd.DataFrame): Register rows or a cube from build_cube.
+
+    Returns:
+    
+        dict: 'Total Projects', 'Network Owners', 'Capacity Change' (MW) and 'Total Capacity' (MW).
+    """
+    cube = _as_cube(df)
+    return {'Total Projects': int(cube['Projects'].sum()),
+            'Network Owners': cube['HOST TO'].nunique(),
+            'Capacity Change': cube['MW Change'].sum(),
+            'Total Capacity': cube['Connection Cap (MW)'].sum()}
 
 
 def plot_project_stat_cap(df):
-    status_proj_cap = df.groupby(["Project Status", "HOST TO"]).agg({"Connection Cap (MW)": "sum",
+    status_proj_cap = df.groupby(["Project Status", "HOST TO"], observed=True).agg({"Connection Cap (MW)": "sum",
                                                                      "Project Name": "count"})
     
     
     
     
     
+def capacity_split(df: pd.DataFrame, primary_col: str, secondary_col: str):
+    """
+    Split connection capacity by one column and break each slice down by another (the doughnut charts).
+
+    Parameters:
+    
+        df (pd.DataFrame): Register rows or a cube from build_cube.
+        primary_col (str): Column the capacity is split by, e.g. 'Project Status'.
+        secondary_col (str): Column each slice is broken down by, e.g. 'HOST TO'.
+
+    Returns:
+    
+        pd.DataFrame: One row per `primary_col` value with its 'Total' capacity (MW)
+                      followed by one column of capacity per `secondary_col` value.
+    """
+    proj_cap = df.groupby(primary_col, observed=True)['Connection Cap (MW)'].sum().reset_index()
+    proj_cap = proj_cap.rename(columns={'Connection Cap (MW)': 'Total'})
+
+    # Create a pivot table for secondary df
+    secondary_df = df.pivot_table(values='Connection Cap (MW)',
+                                    index=primary_col,
+                                    columns=secondary_col,
+                                    aggfunc='sum',
+                                    fill_value=0,
+                                    observed=True)
+
+    # Merge the pivot table with proj_cap
+    return pd.merge(proj_cap, secondary_df, left_on=primary_col, right_index=True)
+
+
+@metrics.timed("plot_conn_capa_dist_by_status_host")
 def plot_conn_capa_dist_by_status_host(df: pd.DataFrame):
     """
     Plot the distribution of connection capacity by project status and HOST TO using pie charts.
 
     Parameters:
     
-        df (DataFrame): A dataframe containing at least the following columns:
-                       'Connection Cap (MW)', 'Project Status', and 'HOST TO'.
+        df (DataFrame): Register rows or a cube from build_cube, containing at least the
+                       following columns: 'Connection Cap (MW)', 'Project Status', and 'HOST TO'.
 
     Returns:
     
@@ -31,37 +145,25 @@ def plot_conn_capa_dist_by_status_host(df: pd.DataFrame):
                                one for Connection capacity by project status and
                                another for connection capacity by HOST TO.
     """
-    def create_hover_text(row, primary_col, secondary_col):
-        hover_text = f"<b>{row[primary_col]}</b><br>"
-        hover_text += f"<b>Total:</b> {row['Total']:.2f} MW<br>"
-        
-        # Filter unique values in the secondary column to only strings
-        unique_statuses = df[secondary_col].dropna().unique()
-        string_statuses = [status for status in unique_statuses if isinstance(status, str)]
+    def create_hover_text(pie_df, primary_col, secondary_labels):
+        # Built column by column over the whole table rather than row by row
+        hover_text = ("<b>" + pie_df[primary_col].astype(str) + "</b><br>"
+                      + "<b>Total:</b> " + np.char.mod("%.2f", pie_df['Total'].to_numpy(dtype=float)) + " MW<br>")
         
-        for status in sorted(string_statuses):
-            if status in row.index and row[status] > 0:  # Only show non-zero values
-                hover_text += f"<b>{status}:</b> {row[status]:.2f} MW<br>"
+        for status in secondary_labels:
+            values = pie_df[status].to_numpy(dtype=float)
+            status_text = np.char.mod(f"<b>{status.replace('%', '%%')}:</b> %.2f MW<br>", values)
+            hover_text += np.where(values > 0, status_text, "")  # Only show non-zero values
         
         return hover_text
 
     def create_pie_df(primary_col: str, secondary_col: str):
         # Prepare the df for the pie chart
-        proj_cap = df.groupby(primary_col)['Connection Cap (MW)'].sum().reset_index()
-        proj_cap = proj_cap.rename(columns={'Connection Cap (MW)': 'Total'})
+        proj_cap = capacity_split(df, primary_col, secondary_col)
 
-        # Create a pivot table for secondary df
-        secondary_df = df.pivot_table(values='Connection Cap (MW)',
-                                        index=primary_col,
-                                        columns=secondary_col,
-                                        aggfunc='sum',
-                                        fill_value=0)
-
-        # Merge the pivot table with proj_cap
-        proj_cap = pd.merge(proj_cap, secondary_df, left_on=primary_col, right_index=True)
-
-        # Create hover text
-        proj_cap['hover_text'] = proj_cap.apply(lambda row: create_hover_text(row, primary_col, secondary_col), axis=1)
+        # Create hover text, listing only the string labels of the secondary column, sorted once
+        secondary_labels = sorted(label for label in proj_cap.columns[2:] if isinstance(label, str))
+        proj_cap['hover_text'] = create_hover_text(proj_cap, primary_col, secondary_labels)
 
         return proj_cap
 
@@ -69,6 +171,10 @@ def plot_conn_capa_dist_by_status_host(df: pd.DataFrame):
     status_df = create_pie_df('Project Status', 'HOST TO')
     host_to_df = create_pie_df('HOST TO', 'Project Status')
 
+    # Plotly is imported on first use, keeping it off the startup path
+    from plotly.subplots import make_subplots
+    import plotly.graph_objects as go
+
     # Create subplots
     fig = make_subplots(rows=1, cols=2, specs=[[{'type':'domain'}, {'type':'domain'}]],
                         subplot_titles=('Connection Capacity by Project Status', 'Connection Capacity by HOST TO'))
@@ -107,47 +213,100 @@ def plot_conn_capa_dist_by_status_host(df: pd.DataFrame):
     return fig
 
 
-def plot_timelines(df):
+# Timeline bucket sizes, finest first, as pandas period frequencies
+TIMELINE_BUCKETS = {'day': 'D', 'month': 'M', 'quarter': 'Q', 'financial year': 'Y-MAR'}
+# Above this many points the timeline is drawn with a WebGL trace instead of SVG
+WEBGL_POINTS = 1000
+
+
+def _bucket_timeline(df: pd.DataFrame, granularity: str):
+    periods = df['Connection Date'].dt.to_period(TIMELINE_BUCKETS[granularity])
+    if granularity == 'financial year':
+        # UK financial years run April to March and are named after both calendar years
+        labels = periods.dt.year.map(lambda year: f"FY{year - 1}/{str(year)[-2:]}", na_action='ignore')
+    else:
+        labels = periods.astype(str)
+
+    return (df.assign(**{'Connection Date': periods.dt.start_time, 'Period': labels})
+              .groupby(['Connection Date', 'Period', 'HOST TO'], observed=True).agg({
+                                                                'Connection Cap (MW)': 'sum',
+                                                                'Projects': 'sum',
+                                                                'Plant Type': 'nunique',
+                                                                'MW Change': 'sum'
+                                                            })
+              .rename(columns={'Projects': 'Project Name'})
+              .reset_index())
+
+
+def timeline_series(df: pd.DataFrame, granularity='day', max_points=2000):
+    """
+    Bucket the register by connection date and HOST TO, as drawn on the timeline chart.
+
+    Parameters:
+    
+        df (pd.DataFrame): Register rows or a cube from build_cube.
+        granularity (str): Bucket size, one of TIMELINE_BUCKETS.
+        max_points (int): Point budget. Coarser buckets are used until the series fits within it.
+
+    Returns:
+    
+        tuple: (DataFrame with 'Connection Date', 'Period', 'HOST TO', 'Connection Cap (MW)',
+                'Project Name' (number of projects), 'Plant Type' (unique plant types) and
+                'MW Change' per bucket, the granularity actually used)
+    """
+    df = _as_cube(df)
+
+    # Grouping the df by 'Connection Date' bucket, downsampling to coarser buckets above the point budget
+    buckets = list(TIMELINE_BUCKETS)
+    for granularity in buckets[buckets.index(granularity):]:
+        time_group = _bucket_timeline(df, granularity)
+        if len(time_group) <= max_points:
+            break
+    return time_group, granularity
+
+
+@metrics.timed("plot_timelines")
+def plot_timelines(df, granularity='day', max_points=2000):
     """
     Create a scatter plot showing the timeline of connection capacity, projects, plant types, and MW change.
 
     Parameters:
     
-        df (pd.DataFrame): A DataFrame containing at least the following columns:
-                       'Connection Date', 'HOST TO', 'Connection Cap (MW)', 
-                       'Project Name', 'Plant Type', and 'MW Change'.
+        df (pd.DataFrame): Register rows or a cube from build_cube, containing at least the
+                       following columns: 'Connection Date', 'HOST TO', 'Connection Cap (MW)', 
+                       'Plant Type', and 'MW Change'.
+        granularity (str): Bucket size of the timeline, one of TIMELINE_BUCKETS.
+        max_points (int): Point budget. Coarser buckets are used automatically until the
+                       timeline fits within it.
 
     Returns:
         
         plotly.express.scatter: A Plotly scatter plot visualizing the data over time.
     """
-    # Grouping the df by 'Connection Date'
-    time_group = df.groupby(['Connection Date', 'HOST TO']).agg({
-                                                                'Connection Cap (MW)': 'sum',
-                                                                'Project Name': 'count',
-                                                                'Plant Type': 'nunique',
-                                                                'MW Change': 'sum'
-                                                            }).reset_index()
+    time_group, granularity = timeline_series(df, granularity, max_points)
 
     # Create a scatter plot
+    import plotly.express as px
     timeline_plot = px.scatter(data_frame=time_group,
                                x='Connection Date',
                                y='Connection Cap (MW)',
                                size='Project Name',  
-                               hover_name='Connection Date', 
+                               hover_name='Period', 
                                color='HOST TO',
                                hover_data={
+                                    'Connection Date': False,
                                     'Project Name': True,
                                     'Plant Type': True,
                                     'MW Change': True},
                                 
-                                title='Timeline of Connection Capacity, Projects, Plant Types, and MW Change',
+                                title=f'Timeline of Connection Capacity, Projects, Plant Types, and MW Change (by {granularity})',
                                 labels={
                                     'Connection Cap (MW)': 'Total Entry Capacity (MW)',
                                     'MW Change': 'Total MW Change',
                                     'Project Name': 'Number of Projects',
                                     'Plant Type': 'Unique Plant Type'
                                 },
+                                render_mode='webgl' if len(time_group) > WEBGL_POINTS else 'svg',
                                 template='plotly_white'
                             )
 
@@ -163,27 +322,30 @@ def plot_timelines(df):
 
 
 
+@metrics.timed("plot_sunburst")
 def plot_sunburst(df: pd.DataFrame):
     """
     Create a sunburst chart to visualize connection capacity by HOST TO, plant type, and project status.
 
     Parameters:
         
-        df (pd.DataFrame): A DataFrame containing at least the following columns:
-                       'Connection Cap (MW)', 'HOST TO', 'Plant Type', 
-                       'Project Status', and 'Project Name'.
+        df (pd.DataFrame): Register rows or a cube from build_cube, containing at least the
+                       following columns: 'Connection Cap (MW)', 'HOST TO', 'Plant Type', 
+                       and 'Project Status'.
 
     Returns:
         
         plotly.express.sunburst: A Plotly sunburst chart visualizing connection capacity.
     """
     
+    df = _as_cube(df)
+
     # Ensure relevant columns are of type string
     df = df.astype({'HOST TO': str, 'Plant Type': str, 'Project Status': str})
 
     # Aggregate the data by the relevant fields
     data = (df.groupby(["HOST TO", "Plant Type", "Project Status"])
-              .agg(Projects=('Project Name', 'size'), Connection_Cap_MW=('Connection Cap (MW)', 'sum'))
+              .agg(Projects=('Projects', 'sum'), Connection_Cap_MW=('Connection Cap (MW)', 'sum'))
               .reset_index())
 
     # Calculate total projects at different levels for hover info
@@ -193,6 +355,7 @@ def plot_sunburst(df: pd.DataFrame):
     
     colors = ["#800080", "#2B5D18", "#FFD700", "#2CFF05"]
 
+    import plotly.express as px
     sun = px.sunburst(
                     data_frame=data,
                     values="Connection Cap (GW)",
@@ -210,33 +373,52 @@ def plot_sunburst(df: pd.DataFrame):
 
 
 
-def plot_plant_type_cap(df: pd.DataFrame):
+def plant_type_capacity(df: pd.DataFrame):
     """
-    Create a bar chart visualizing connection capacity by plant type and HOST TO.
+    Total connection capacity per plant type and HOST TO.
 
     Parameters:
         
-        df (pd.DataFrame): A DataFrame containing at least the following columns:
-                       'Plant Type', 'HOST TO', and 'Connection Cap (MW)'.
+        df (pd.DataFrame): Register rows or a cube from build_cube.
 
     Returns:
         
-        plotly.graph_objs.Figure: A Plotly bar chart showing the distribution of connection capacity.
+        pd.DataFrame: Long table of 'Plant Type', 'HOST TO' and 'Connection Cap (MW)',
+                      with zero rows for combinations without capacity.
     """
-    capacity_by_TO_plant = df.pivot_table(
+    capacity_by_TO_plant = _as_cube(df).pivot_table(
                                         index="Plant Type",
                                         columns="HOST TO",
                                         values="Connection Cap (MW)",
                                         fill_value=0,
                                         aggfunc="sum",
+                                        observed=True,
                                         )
     
-    unpivot_capacity_by_TO_plant = (capacity_by_TO_plant
-                                    .reset_index()
-                                    .melt(id_vars="Plant Type",
-                                        value_name="Connection Cap (MW)",
-                                        var_name="HOST TO"))
+    return (capacity_by_TO_plant
+            .reset_index()
+            .melt(id_vars="Plant Type",
+                value_name="Connection Cap (MW)",
+                var_name="HOST TO"))
+
+
+@metrics.timed("plot_plant_type_cap")
+def plot_plant_type_cap(df: pd.DataFrame):
+    """
+    Create a bar chart visualizing connection capacity by plant type and HOST TO.
+
+    Parameters:
+        
+        df (pd.DataFrame): Register rows or a cube from build_cube, containing at least the
+                       following columns: 'Plant Type', 'HOST TO', and 'Connection Cap (MW)'.
+
+    Returns:
+        
+        plotly.graph_objs.Figure: A Plotly bar chart showing the distribution of connection capacity.
+    """
+    unpivot_capacity_by_TO_plant = plant_type_capacity(df)
     
+    import plotly.express as px
     fig = px.bar(data_frame=unpivot_capacity_by_TO_plant.sort_values(by="HOST TO"),
                  x="Plant Type",
                  y="Connection Cap (MW)",
@@ -255,4 +437,39 @@ def plot_plant_type_cap(df: pd.DataFrame):
             'font': {'size': 24}
         }
     )
-    return fig
\ No newline at end of file
+    return fig
+
+@metrics.timed("plot_cumulative_capacity")
+def plot_cumulative_capacity(series: pd.DataFrame):
+    """
+    Create a stacked area chart of the connection capacity connected over time by HOST TO.
+
+    Parameters:
+        
+        series (pd.DataFrame): Running totals from timeseries.cumulative_series, split by
+                       'HOST TO', with 'Connection Date', 'Connection Cap (MW)', 'MW Change'
+                       and 'Projects'.
+
+    Returns:
+        
+        plotly.graph_objs.Figure: A Plotly area chart of cumulative connection capacity.
+    """
+    import plotly.express as px
+    fig = px.area(data_frame=series,
+                  x='Connection Date',
+                  y='Connection Cap (MW)',
+                  color='HOST TO',
+                  hover_data={'Projects': True, 'MW Change': ':.2f'},
+                  labels={'Connection Cap (MW)': 'Cumulative Connection Capacity (MW)',
+                          'MW Change': 'Cumulative MW Change',
+                          'Projects': 'Projects Connected'},
+                  line_shape='hv',
+                  template='plotly_white')
+
+    fig.update_layout(title={'text': "Cumulative Connection Capacity by Connection Date and Host TO",
+                             'x': 0.5,
+                             'xanchor': 'center'},
+                      yaxis_title='Cumulative Connection Capacity (MW)',
+                      xaxis_title='Connection Date',
+                      legend_title='HOST TO')
+    return fig
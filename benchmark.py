@@ -0,0 +1,215 @@
+"""
+Headless benchmarks for the load -> preprocess -> filter -> plot pipeline.
+
+Runs offline against datastore/tecregister.csv and synthetically scaled copies
+of it, timing each stage and recording its peak traced memory. Results are
+written as JSON lines, one record per (scale, stage), so runs from different
+commits can be compared:
+
+    python benchmark.py --scales 1 10 100 --output bench-new.jsonl
+    python benchmark.py --compare bench-old.jsonl bench-new.jsonl
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import data_loader
+import artist
+from figure_cache import figure_to_json
+import neso_stub
+
+__all__ = ['scale_register', 'run_benchmarks']
+
+PLOTS = ['plot_plant_type_cap', 'plot_sunburst', 'plot_conn_capa_dist_by_status_host', 'plot_timelines']
+SELECTIONS = {'HOST TO': ['SHET', 'SPT'],
+              'Project Status': ['Scoping', 'Built', 'Awaiting Consents'],
+              'Agreement Type': ['Direct Connection', 'Embedded']}
+
+
+def scale_register(source: str, scale: int, dest: str):
+    """
+    Write a copy of the register with every row repeated `scale` times.
+
+    Copies get distinct Project IDs and Project Numbers and their connection dates
+    shifted by whole days, so identifiers stay unique and the timeline grows.
+
+    Parameters:
+
+        source (str): The register CSV to scale.
+        scale (int): Number of copies of each row.
+        dest (str): Where to write the scaled CSV.
+    """
+    df = pd.read_csv(source)
+    dates = pd.to_datetime(df["MW Effective From"], errors="coerce")
+    with open(dest, "w", newline="") as f:
+        for copy in range(scale):
+            part = df.copy()
+            if copy:
+                part["Project ID"] = part["Project ID"] + f"-{copy}"
+                part["Project Number"] = part["Project Number"] + f"-{copy}"
+                part["MW Effective From"] = (dates + pd.Timedelta(days=copy % 365)).dt.strftime("%Y-%m-%d")
+            part.to_csv(f, header=not copy, index=False)
+
+
+def _measure(stage_func, repeats):
+    """Return (result, timings, peak traced bytes) for `stage_func`."""
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = stage_func()
+        timings.append(time.perf_counter() - start)
+
+    # Memory is measured on a separate pass, as tracing slows the stage down
+    tracemalloc.start()
+    stage_func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, timings, peak
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(source="datastore/tecregister.csv", scales=(1, 10, 100, 1000), repeats=3):
+    """
+    Benchmark every pipeline stage at each scale.
+
+    Parameters:
+
+        source (str): The register CSV to benchmark against.
+        scales (iterable[int]): Row multipliers to run at.
+        repeats (int): Timed runs per stage.
+
+    Yields:
+
+        dict: One record per (scale, stage) with timings in seconds and peak memory in bytes.
+    """
+    run_info = {"commit": _git_commit(),
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    workdir = tempfile.mkdtemp(prefix="tec-bench-")
+    datastore = data_loader.DATASTORE
+    try:
+        data_loader.DATASTORE = workdir
+        for scale in scales:
+            csv_path = os.path.join(workdir, f"source-{scale}.csv")
+            scale_register(source, scale, csv_path)
+            stub = neso_stub.serve(csv_path)
+
+            def fresh_download():
+                for name in os.listdir(workdir):
+                    if name.startswith("tecregister"):
+                        os.remove(os.path.join(workdir, name))
+                data_loader._parsed_cache.clear()
+                return data_loader.download_data(stub.register_url)
+
+            raw = None
+            stages = [
+                ("download", fresh_download),
+                ("download_not_modified", lambda: data_loader.download_data(stub.register_url)),
+                ("preprocess_df", lambda: data_loader.preprocess_df(raw.copy())),
+                ("load_register_snapshot", lambda: data_loader.load_register(stub.register_url)),
+            ]
+            results = {}
+            for stage, func in stages:
+                results[stage], timings, peak = _measure(func, repeats)
+                if stage == "download":
+                    raw = results[stage]
+                    # Build the snapshot up front so only snapshot loads are timed
+                    data_loader.load_register(stub.register_url)
+                yield {**run_info, "scale": scale, "rows": len(raw), "stage": stage,
+                       "seconds_median": statistics.median(timings), "seconds_min": min(timings),
+                       "repeats": repeats, "peak_bytes": peak}
+            stub.shutdown()
+            stub.server_close()
+
+            df = results["preprocess_df"]
+            filter_index, timings, peak = _measure(lambda: data_loader.build_filter_index(df), repeats)
+            records = [("build_filter_index", timings, peak)]
+
+            def filter_isin():
+                mask = True
+                for feature, values in SELECTIONS.items():
+                    mask = mask & df[feature].isin(values)
+                return df[mask]
+
+            _, timings, peak = _measure(filter_isin, repeats)
+            records.append(("filter_isin", timings, peak))
+            _, timings, peak = _measure(lambda: df[data_loader.filter_mask(filter_index, SELECTIONS)], repeats)
+            records.append(("filter_index", timings, peak))
+
+            cube, timings, peak = _measure(lambda: artist.build_cube(df), repeats)
+            records.append(("build_cube", timings, peak))
+            cube_index = data_loader.build_filter_index(cube)
+            cube_slice, timings, peak = _measure(lambda: cube[data_loader.filter_mask(cube_index, SELECTIONS)], repeats)
+            records.append(("filter_cube", timings, peak))
+
+            for plot in PLOTS:
+                plot_func = getattr(artist, plot)
+                fig, timings, peak = _measure(lambda: plot_func(cube_slice), repeats)
+                records.append((plot, timings, peak))
+                _, timings, peak = _measure(lambda: figure_to_json(fig), repeats)
+                records.append((f"{plot}_to_json", timings, peak))
+
+            for stage, timings, peak in records:
+                yield {**run_info, "scale": scale, "rows": len(df), "stage": stage,
+                       "seconds_median": statistics.median(timings), "seconds_min": min(timings),
+                       "repeats": repeats, "peak_bytes": peak}
+    finally:
+        data_loader.DATASTORE = datastore
+        data_loader._parsed_cache.clear()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(base_path, new_path):
+    """Print the median-time and peak-memory ratio of each stage between two result files."""
+    def read(path):
+        with open(path) as f:
+            return {(r["scale"], r["stage"]): r for r in map(json.loads, f)}
+
+    base, new = read(base_path), read(new_path)
+    print(f"{'scale':>6} {'stage':<42} {'base s':>10} {'new s':>10} {'time x':>8} {'mem x':>8}")
+    for key in sorted(base.keys() & new.keys()):
+        b, n = base[key], new[key]
+        time_ratio = n["seconds_median"] / b["seconds_median"] if b["seconds_median"] else float("nan")
+        mem_ratio = n["peak_bytes"] / b["peak_bytes"] if b["peak_bytes"] else float("nan")
+        print(f"{key[0]:>6} {key[1]:<42} {b['seconds_median']:>10.4f} {n['seconds_median']:>10.4f} "
+              f"{time_ratio:>8.2f} {mem_ratio:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the TEC register pipeline.")
+    parser.add_argument("--source", default="datastore/tecregister.csv")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="Write JSON lines here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NEW"), help="Compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for record in run_benchmarks(args.source, args.scales, args.repeats):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
@@ -1,94 +1,1047 @@
-import requests
 import os
-from bs4 import BeautifulSoup
+import json
+import hashlib
+import re
+import sqlite3
+import tempfile
+from contextlib import closing, contextmanager
+from glob import glob
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
+import metrics
 
-__all__ = ['download_data', 'extract_last_date_updated', 'preprocess_df']
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
-def download_data(url="https://api.neso.energy/dataset/cbd45e54-e6e2-4a38-99f1-8de6fd96d7c1/resource/17becbab-e3e8-473f-b303-3806f43a6a10/download/tec-register-27-09-2024.csv",
-                  filename="tecregister.csv"):
+__all__ = ['download_data', 'get_dataset_version', 'extract_last_date_updated', 'preprocess_df',
+           'get_release_date', 'load_register', 'datastore_lock', 'read_snapshot', 'make_read_only', 'build_filter_index', 'filter_mask',
+           'build_search_index', 'search_mask', 'read_register_batches', 'ingest_register',
+           'diff_releases', 'load_change_history', 'load_changes',
+           'release_date_from_name', 'ingest_release', 'ingest_archive', 'list_releases', 'query_archive']
+
+DATASTORE = os.environ.get("TEC_DATASTORE", "datastore")
+PAGE_URL = "https://www.neso.energy/data-portal/transmission-entry-capacity-tec-register"
+REGISTER_URL = "https://api.neso.energy/dataset/cbd45e54-e6e2-4a38-99f1-8de6fd96d7c1/resource/17becbab-e3e8-473f-b303-3806f43a6a10/download/tec-register-27-09-2024.csv"
+
+CATEGORY_COLUMNS = ["HOST TO", "Project Status", "Agreement Type", "Plant Type"]
+FILTER_COLUMNS = ["HOST TO", "Project Status", "Agreement Type"]
+DIFF_KEYS = ["Project ID", "Project Number"]
+SEARCH_COLUMNS = ["Project Name", "Customer Name", "Connection Site", "Project ID", "Project Number"]
+CHANGE_TYPES = ["inserted", "removed", "updated_before", "updated_after"]
+# Rows hashed at a time when diffing two releases
+DIFF_BATCH_ROWS = 50_000
+# Raw register columns and the dtype each is parsed to; rows that do not parse are quarantined
+REGISTER_DTYPES = {"Project Name": "string", "Customer Name": "string", "Connection Site": "string",
+                   "Stage": "float64", "MW Connected": "float64", "MW Increase / Decrease": "float64",
+                   "Cumulative Total Capacity (MW)": "float64", "MW Effective From": "datetime64[ns]",
+                   "Project Status": "category", "Agreement Type": "category", "HOST TO": "category",
+                   "Plant Type": "category", "Project ID": "string", "Project Number": "string"}
+REQUIRED_VALUES = ["MW Connected", "MW Increase / Decrease", "Cumulative Total Capacity (MW)",
+                   "Project Status", "HOST TO", "Project ID", "Project Number"]
+RENAMES = {"MW Increase / Decrease": "MW Change",
+           "Cumulative Total Capacity (MW)": "Connection Cap (MW)",
+           "MW Effective From": "Connection Date"}
+ARCHIVE_INDEXES = {"HOST TO": "host_to", "Project Status": "project_status",
+                   "Plant Type": "plant_type", "Project ID": "project_id"}
+
+# filepath -> (sha256, parsed DataFrame) of the last CSV read from disk
+_parsed_cache = {}
+
+
+@contextmanager
+def datastore_lock():
+    """
+    Hold the datastore's exclusive lock for the enclosed block.
+
+    Worker processes can share a datastore, each with its own refresher, so every
+    step that replaces the register, its snapshot, change log or archive runs
+    under this lock. It is an advisory lock on a file in the datastore, and a
+    no-op where `fcntl` is unavailable.
+    """
+    os.makedirs(DATASTORE, exist_ok=True)
+    with open(f"{DATASTORE}/.lock", "a") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        # Closing the file releases the lock
+        yield
+
+
+def _temp_path(path):
+    # A fresh file next to `path`, unique to this writer, so os.replace onto `path` stays atomic
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.",
+                                    suffix=".tmp")
+    os.close(fd)
+    return tmp_path
+
+
+@contextmanager
+def _replacing(path):
+    """Yield a temporary path that replaces `path` if the block succeeds and is removed otherwise."""
+    tmp_path = _temp_path(path)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_meta(filepath):
+    try:
+        with open(f"{filepath}.meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(filepath, meta):
+    with _replacing(f"{filepath}.meta.json") as tmp_path, open(tmp_path, "w") as f:
+        json.dump(meta, f)
+
+
+def _file_sha256(filepath, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@metrics.timed("download")
+def _fetch_register(url, filepath, timeout, chunk_size, raise_errors=False):
+    """
+    Conditionally fetch the register into `filepath`, streaming the body to disk.
+
+    Returns:
+    
+        dict: The cache metadata for the file on disk, or an empty dict when
+              nothing could be fetched and no local copy exists.
+    """
+    meta = _read_meta(filepath)
+    have_file = os.path.exists(filepath)
+    if url is None:
+        # Offline: use the copy already in the datastore without contacting the portal
+        if not have_file:
+            return {}
+        if not meta.get("sha256"):
+            meta = {**meta, "sha256": _file_sha256(filepath)}
+            _write_meta(filepath, meta)
+        return meta
+
+    # requests is imported on first use, keeping it off the startup path
+    import requests
+
+    headers = {}
+    if have_file and meta.get("url") == url:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+            if resp.status_code == 304:
+                pass
+            elif resp.ok:
+                digest = hashlib.sha256()
+                tmp_path = _temp_path(filepath)
+                try:
+                    with open(tmp_path, "wb") as f:
+                        for chunk in resp.iter_content(chunk_size=chunk_size):
+                            digest.update(chunk)
+                            f.write(chunk)
+                    meta = {"url": url,
+                            "etag": resp.headers.get("ETag"),
+                            "last_modified": resp.headers.get("Last-Modified"),
+                            "fetched_at": pd.Timestamp.now("UTC").isoformat(),
+                            "sha256": digest.hexdigest()}
+                    # The file and its metadata are swapped together, once the download is complete
+                    with datastore_lock():
+                        os.replace(tmp_path, filepath)
+                        _write_meta(filepath, meta)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                return meta
+            elif raise_errors:
+                resp.raise_for_status()
+            elif not have_file:
+                return {}
+    except requests.RequestException:
+        if raise_errors:
+            raise
+        # Portal unreachable: fall back to whatever copy we already hold
+        if not have_file:
+            return {}
+
+    if not meta.get("sha256"):
+        meta = {**meta, "url": url, "sha256": _file_sha256(filepath)}
+        _write_meta(filepath, meta)
+    return meta
+
+
+def download_data(url=REGISTER_URL, filename="tecregister.csv", timeout=30, chunk_size=1 << 16):
     """
     Download data from the specified URL and save it to a file.
 
+    The request is conditional on the ETag/Last-Modified of the copy already in
+    the datastore, the body is streamed to disk in chunks, and the existing file
+    is used when the portal is unreachable. The CSV is only re-parsed when its
+    content hash changes.
+
     Parameters:
         url (str): The URL to download data from.
         filename (str): The name of the file where the data will be saved.
+        timeout (float): Seconds to wait on the portal before falling back to the local copy.
+        chunk_size (int): Bytes written to disk per streamed chunk.
 
     Returns:
     
         DataFrame: Dataframe of csv file downloaded.
     """
-    resp = requests.get(url)
-    
-    if resp.ok:
-        os.makedirs("datastore", exist_ok=True)
-        filepath = f"datastore/{filename}"
-        
-        with open(filepath, "wb") as f:
-            f.write(resp.content)
-        return pd.read_csv(filepath)
-    else:
+    os.makedirs(DATASTORE, exist_ok=True)
+    filepath = f"{DATASTORE}/{filename}"
+
+    meta = _fetch_register(url, filepath, timeout, chunk_size)
+    if not meta:
         return pd.DataFrame([])
+
+    return _read_register(filepath, meta["sha256"])
+
+
+@metrics.timed("read_csv")
+def _read_register(filepath, sha256):
+    cached = _parsed_cache.get(filepath)
+    if cached is None or cached[0] != sha256:
+        cached = (sha256, pd.read_csv(filepath))
+        _parsed_cache[filepath] = cached
+    # preprocess_df renames in place, so never hand out the cached frame itself
+    return cached[1].copy()
+
+
+def get_dataset_version(filename="tecregister.csv"):
+    """
+    Return the content hash of the register held in the datastore.
+
+    Parameters:
     
+        filename (str): The name of the register file in the datastore.
+
+    Returns:
+    
+        str: The sha256 of the file, or None when no register has been downloaded.
+    """
+    return _read_meta(f"{DATASTORE}/{filename}").get("sha256")
 
 
-def extract_last_date_updated():
+def get_release_date(filename="tecregister.csv"):
     """
-    Extract the last updated date from a webpage using a CSS selector.
+    Date the register held in the datastore was published, for the archive.
+
+    The portal serves every release from the same URL, so the date is taken from
+    the response's Last-Modified header, or from when it was fetched.
+
+    Parameters:
+    
+        filename (str): The name of the register file in the datastore.
+
+    Returns:
+    
+        str: The ISO date, or None when no register has been downloaded.
+    """
+    path = f"{DATASTORE}/{filename}"
+    if not os.path.exists(path):
+        return None
+    meta = _read_meta(path)
+    for stamp in (meta.get("last_modified"), meta.get("fetched_at")):
+        date = pd.to_datetime(stamp, errors="coerce", utc=True) if stamp else pd.NaT
+        if not pd.isna(date):
+            return date.strftime("%Y-%m-%d")
+    return pd.Timestamp(os.path.getmtime(path), unit="s").strftime("%Y-%m-%d")
+
+
+
+@metrics.timed("extract_last_date_updated")
+def extract_last_date_updated(url=PAGE_URL, timeout=10, raise_errors=False):
+    """
+    Extract the last updated date from the register's page on the NESO data portal.
 
     Parameters:
     
         url (str): The URL of the webpage to scrape.
         
-        selector (str): The CSS selector to locate the target elements.
+        timeout (float): Seconds to wait for the page.
+        
+        raise_errors (bool): Raise request errors instead of returning a placeholder text.
 
     Returns:
     
-        str: The text of the first matching element containing "ago" if found,
-            otherwise "Element not found".
-        List[str]: If a request error occurs, returns a list containing the error message.
+        str: The text of the page's first <time> element if found,
+            otherwise "unknown, but less than 4 weeks", or "Error fetching the URL"
+            if a request error occurs.
     """
-    
-    url = 'https://www.neso.energy/data-portal/transmission-entry-capacity-tec-register'
+    import requests
+    from bs4 import BeautifulSoup
 
     try:
-        response = requests.get(url)
+        response = requests.get(url, timeout=timeout)
         
         # Check if the response is successful
         if response.status_code != 200:
+            if raise_errors:
+                response.raise_for_status()
             return "unknown, but less than 4 weeks"
         
         soup = BeautifulSoup(response.text, "lxml")
         return soup.find("time").text 
 
     except requests.RequestException as e:
+        if raise_errors:
+            raise
         return f"Error fetching the URL"
 
 
 # Convert to datetime and format date
-def preprocess_df(df: pd.DataFrame):
+@metrics.timed("preprocess_df")
+def preprocess_df(df: pd.DataFrame, categories=CATEGORY_COLUMNS):
     """
     Preprocess the DataFrame by converting date columns and renaming specific columns.
 
     Parameters:
     
         df (pd.DataFrame): The DataFrame to preprocess.
+        categories (list[str]): Columns to convert to category dtype. Batches written
+                                to the snapshot keep them as strings instead.
 
     Returns:
     
-        pd.DataFrame: The preprocessed DataFrame with updated column names and 
-                    'MW Effective From' converted to datetime format.
+        pd.DataFrame: The preprocessed DataFrame with updated column names,
+                    'MW Effective From' converted to datetime format and the
+                    low-cardinality columns in `categories` as category dtype.
     """
     df["MW Effective From"] = pd.to_datetime(df["MW Effective From"], errors="coerce")
-    df.rename(
-                columns={
-                    "MW Increase / Decrease": "MW Change",
-                    "Cumulative Total Capacity (MW)": "Connection Cap (MW)",
-                    "MW Effective From": "Connection Date",
-                },
-                inplace=True,
-            )
+    df.rename(columns=RENAMES, inplace=True)
+    for col in categories:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    
+    return df
+
+
+def _validate_batch(batch):
+    # Parse the typed columns of a batch read as strings, splitting off rows that fail
+    reason = pd.Series(None, index=batch.index, dtype=object)
+    for col in REQUIRED_VALUES:
+        reason = reason.mask(reason.isna() & batch[col].isna(), f"missing {col}")
+
+    parsed = {}
+    for col, dtype in REGISTER_DTYPES.items():
+        if dtype == "float64":
+            parsed[col] = pd.to_numeric(batch[col], errors="coerce")
+        elif dtype == "datetime64[ns]":
+            parsed[col] = pd.to_datetime(batch[col], errors="coerce")
+        else:
+            continue
+        reason = reason.mask(reason.isna() & parsed[col].isna() & batch[col].notna(), f"unparseable {col}")
+
+    bad = reason.notna()
+    good = batch.assign(**parsed)[~bad.to_numpy()]
+    return good, batch[bad.to_numpy()].assign(**{"Quarantine Reason": reason[bad]})
+
+
+def read_register_batches(path, chunksize=10_000, quarantine_path=None):
+    """
+    Parse a register CSV in bounded batches, validating and preprocessing each one.
+
+    Only one batch is held in memory at a time, whatever the size of the file.
+    Rows with missing required values or values that do not parse as their
+    REGISTER_DTYPES dtype, and lines with too many fields, are appended to
+    `quarantine_path` with a 'Quarantine Reason' instead of being loaded.
+
+    Parameters:
+    
+        path (str): The register CSV.
+        chunksize (int): Rows per batch.
+        quarantine_path (str): CSV the rejected rows are written to. None drops them.
+
+    Yields:
+    
+        pd.DataFrame: Preprocessed batches, with the CATEGORY_COLUMNS left as strings.
+
+    Raises:
+    
+        ValueError: If the file lacks any of the REGISTER_DTYPES columns.
+    """
+    header = pd.read_csv(path, nrows=0).columns
+    missing = set(REGISTER_DTYPES) - set(header)
+    if missing:
+        raise ValueError(f"{path} is missing register columns: {', '.join(sorted(missing))}")
+
+    quarantined = 0
+
+    def quarantine(rows):
+        nonlocal quarantined
+        if quarantine_path is not None and len(rows):
+            os.makedirs(os.path.dirname(quarantine_path) or ".", exist_ok=True)
+            rows.to_csv(quarantine_path, mode="a" if quarantined else "w", header=not quarantined, index=False)
+            quarantined += len(rows)
+
+    skipped_lines = []
+
+    def skip_line(fields):
+        # Lines with too many fields are kept for the quarantine rather than loaded
+        skipped_lines.append([*fields[:len(header)], f"expected {len(header)} fields, saw {len(fields)}"])
+
+    # The callable on_bad_lines needs the python engine; it is slower, but keeps no state beyond the batch
+    for batch in pd.read_csv(path, dtype=str, chunksize=chunksize, engine="python", on_bad_lines=skip_line):
+        good, bad = _validate_batch(batch)
+        quarantine(bad)
+        quarantine(pd.DataFrame(skipped_lines, columns=[*header, "Quarantine Reason"]))
+        skipped_lines.clear()
+        yield preprocess_df(good, categories=())
+
+
+@metrics.timed("ingest_register")
+def ingest_register(csv_path, snapshot_path, source_sha256, chunksize=10_000):
+    """
+    Stream a register CSV into a snapshot batch by batch, with bounded peak memory.
+
+    Parameters:
+    
+        csv_path (str): The register CSV.
+        snapshot_path (str): Destination of the snapshot.
+        source_sha256 (str): Hash of the CSV, recorded in the snapshot's schema.
+        chunksize (int): Rows parsed and written per batch.
+
+    Returns:
+    
+        dict: 'rows' loaded and 'quarantined' rows, and the 'quarantine_path' they were written to.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    arrow_types = {"float64": pa.float64(), "datetime64[ns]": pa.timestamp("ns")}
+    schema = pa.schema([(RENAMES.get(col, col), arrow_types.get(REGISTER_DTYPES.get(col), pa.string()))
+                        for col in header],
+                       metadata={b"source_sha256": source_sha256.encode()})
+    quarantine_path = f"{DATASTORE}/quarantine/{source_sha256[:16]}.csv"
+    if os.path.exists(quarantine_path):
+        os.remove(quarantine_path)
+
+    rows = 0
+    with _replacing(snapshot_path) as tmp_path:
+        with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+            for batch in read_register_batches(csv_path, chunksize, quarantine_path):
+                writer.write_batch(pa.RecordBatch.from_pandas(batch, schema=schema, preserve_index=False))
+                rows += len(batch)
+
+    quarantined = len(pd.read_csv(quarantine_path, usecols=["Quarantine Reason"])) if os.path.exists(quarantine_path) else 0
+    return {"rows": rows, "quarantined": quarantined, "quarantine_path": quarantine_path if quarantined else None}
+
+
+def _snapshot_source(path):
+    """Return the source CSV hash recorded in a snapshot's schema, or None."""
+    try:
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return None
+    sha = metadata.get(b"source_sha256")
+    return sha.decode() if sha else None
+
+
+# Freezing a frame in place has no public pandas API, so the helpers below reach into
+# pandas internals: the block manager's arrays, the `_ndarray` holding datetime values
+# and category codes, and the `_pa_array` attribute every in-place write to an Arrow
+# string array goes through. They are written against pandas 2.2 (see requirements.txt)
+# and kept here so an upgrade only needs to revisit this block.
+
+class _ReadOnlyArrowStringArray(pd.arrays.ArrowStringArray):
+    """ArrowStringArray that refuses in-place writes once frozen. Arrays derived from it are writable."""
+
+    def __setattr__(self, name, value):
+        if name == "_pa_array" and self.__dict__.get("_frozen"):
+            raise ValueError("assignment destination is read-only")
+        super().__setattr__(name, value)
+
+    def __getstate__(self):
+        # Pickled copies are the receiver's own, so they are writable
+        state = super().__getstate__()
+        state.pop("_frozen", None)
+        return state
+
+
+def _freeze_array(values):
+    if isinstance(values, pd.arrays.ArrowStringArray):
+        values.__class__ = _ReadOnlyArrowStringArray
+        values._frozen = True
+        return
+    # Datetime and categorical arrays keep their values/codes in `_ndarray`
+    ndarray = getattr(values, "_ndarray", values)
+    if isinstance(ndarray, np.ndarray):
+        ndarray.flags.writeable = False
+
+
+def make_read_only(df: pd.DataFrame):
+    """
+    Make the frame's columns read-only, in place.
+
+    Frames shared by every session are handed out without copying their data,
+    so any in-place write to their values (`iloc`/`loc` assignment, `fillna`
+    with `inplace=True`, ...) raises instead of leaking into other sessions.
+    Derived frames (filters, selections, `copy()`) are writable as usual. Adding,
+    replacing or dropping columns changes the frame object itself, so callers
+    that do that work on a `copy(deep=False)`.
+
+    Parameters:
+    
+        df (pd.DataFrame): The frame to freeze.
+
+    Returns:
+    
+        pd.DataFrame: The same frame.
+    """
+    for values in df._mgr.arrays:
+        _freeze_array(values)
+    return df
+
+
+@metrics.timed("read_snapshot")
+def read_snapshot(path: str):
+    """
+    Load a register snapshot memory-mapped, without copying it onto the heap.
+
+    Strings stay in Arrow memory (string[pyarrow]) and null-free numeric columns
+    are views of the mapped file, so most of the register lives in the OS page
+    cache, shared by every worker process that maps the same snapshot. Only the
+    columns pandas cannot view directly (categories, nullable dates and floats)
+    are converted. The frame is read-only (see make_read_only).
+
+    Parameters:
+    
+        path (str): Location of the snapshot.
+
+    Returns:
+    
+        pd.DataFrame: The preprocessed register with its category and datetime dtypes.
+    """
+    table = feather.read_table(path, memory_map=True)
+    streamed = []
+    for col in CATEGORY_COLUMNS:
+        # Snapshots streamed by ingest_register hold these as plain strings
+        i = table.schema.get_field_index(col)
+        if i >= 0 and (pa.types.is_string(table.schema.field(i).type)
+                       or pa.types.is_large_string(table.schema.field(i).type)):
+            table = table.set_column(i, col, table.column(i).dictionary_encode())
+            streamed.append(col)
+    df = table.to_pandas(split_blocks=True,
+                         types_mapper={pa.string(): pd.StringDtype("pyarrow"),
+                                       pa.large_string(): pd.StringDtype("pyarrow")}.get)
+    for col in streamed:
+        # Same category order as astype("category") gives
+        df[col] = df[col].cat.reorder_categories(sorted(df[col].cat.categories))
+    return make_read_only(df)
+
+
+@metrics.timed("load_register")
+def load_register(url=REGISTER_URL, filename="tecregister.csv", timeout=30, raise_errors=False):
+    """
+    Load the preprocessed register, rebuilding its columnar snapshot only when the source CSV changes.
+
+    The first ingest parses the CSV in bounded batches. A refresh also diffs the
+    new release against the stored one for the change log, which maps both
+    snapshots in full, so its peak memory does grow with the size of the register.
+
+    Parameters:
+    
+        url (str): The URL to download data from, or None to use the copy already in the datastore.
+        filename (str): The name of the CSV file in the datastore.
+        timeout (float): Seconds to wait on the portal before falling back to the local copy.
+        raise_errors (bool): Raise request errors instead of falling back to the local copy.
+
+    Returns:
+    
+        pd.DataFrame: The preprocessed register.
+    """
+    os.makedirs(DATASTORE, exist_ok=True)
+    filepath = f"{DATASTORE}/{filename}"
+    snapshot_path = f"{os.path.splitext(filepath)[0]}.feather"
+
+    meta = _fetch_register(url, filepath, timeout, chunk_size=1 << 16, raise_errors=raise_errors)
+    if not meta:
+        return pd.DataFrame([])
+
+    with datastore_lock():
+        # Another process sharing the datastore may have swapped in a newer release since the fetch
+        meta = _read_meta(filepath) or meta
+        previous = _snapshot_source(snapshot_path)
+        if previous != meta["sha256"]:
+            # Stream the new release into a staging snapshot, so parsing never holds the whole CSV
+            with _replacing(snapshot_path) as staging_path:
+                ingest_register(filepath, staging_path, meta["sha256"])
+                if previous is not None:
+                    stored, register = read_snapshot(snapshot_path), read_snapshot(staging_path)
+                    if set(stored.columns) == set(register.columns):
+                        # Same schema: keep a log of what changed, then swap in the staged snapshot as it is
+                        _record_changes(diff_releases(stored, register), release=meta["sha256"], previous=previous)
+    return read_snapshot(snapshot_path)
+
+
+def _row_hashes(df, columns):
+    # 64-bit hash of each row's values, taken batch by batch so only one batch of the frame is ever copied
+    batches = [pd.util.hash_pandas_object(df.iloc[start:start + DIFF_BATCH_ROWS][columns], index=False).to_numpy()
+               for start in range(0, len(df), DIFF_BATCH_ROWS)]
+    return np.concatenate(batches) if batches else np.empty(0, dtype=np.uint64)
+
+
+def _release_keys(df, keys):
+    # The odd project is listed twice under the same keys, so number repeats to keep keys unique
+    key_hashes = _row_hashes(df, keys)
+    occurrence = pd.Series(key_hashes).groupby(key_hashes, sort=False).cumcount().to_numpy()
+    combined = pd.util.hash_pandas_object(pd.DataFrame({"key": key_hashes, "occurrence": occurrence}), index=False)
+    return combined.to_numpy(), occurrence
+
+
+def _keyed_rows(df, columns, keys, positions, occurrence):
+    rows = df.iloc[positions][columns]
+    return rows.set_axis(pd.MultiIndex.from_arrays([rows[key].to_numpy() for key in keys] + [occurrence[positions]]))
+
+
+def _decategorise(df):
+    return df.astype({col: object for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)})
+
+
+def diff_releases(old: pd.DataFrame, new: pd.DataFrame, keys=DIFF_KEYS):
+    """
+    Work out which rows were inserted, removed or updated between two releases.
+
+    Rows are matched and compared by 64-bit hashes of their keys and values,
+    computed in batches, so besides the changed rows themselves the diff holds
+    a few integers per row rather than copies of both releases.
+
+    Parameters:
+    
+        old (pd.DataFrame): The stored (preprocessed) register.
+        new (pd.DataFrame): The new (preprocessed) release.
+        keys (list[str]): Columns identifying a row across releases.
+
+    Returns:
+    
+        dict: DataFrames keyed by 'inserted', 'removed', 'updated_before' and 'updated_after',
+              indexed by the row keys plus an occurrence number for keys listed more than once.
+              The two 'updated' frames hold the old and new values of the same rows.
+    """
+    columns = list(old.columns)
+    old_keys, old_occurrence = _release_keys(old, keys)
+    new_keys, new_occurrence = _release_keys(new, keys)
+
+    # Position of each new row in the old release, or -1 for rows that are new
+    matches = pd.Index(old_keys).get_indexer(new_keys)
+    matched = matches >= 0
+    old_matched = np.zeros(len(old), dtype=bool)
+    old_matched[matches[matched]] = True
+
+    new_common = np.flatnonzero(matched)
+    old_common = matches[matched]
+    changed = _row_hashes(old, columns)[old_common] != _row_hashes(new, columns)[new_common]
+    # Updated rows in the order of the old release
+    order = np.argsort(old_common[changed], kind="stable")
+
+    return {"inserted": _keyed_rows(new, columns, keys, np.flatnonzero(~matched), new_occurrence),
+            "removed": _keyed_rows(old, columns, keys, np.flatnonzero(~old_matched), old_occurrence),
+            "updated_before": _keyed_rows(old, columns, keys, old_common[changed][order], old_occurrence),
+            "updated_after": _keyed_rows(new, columns, keys, new_common[changed][order], new_occurrence)}
+
+
+def _record_changes(changes, release, previous):
+    history_dir = f"{DATASTORE}/changes"
+    os.makedirs(history_dir, exist_ok=True)
+    path = f"{history_dir}/{release[:16]}.feather"
+
+    log = pd.concat([_decategorise(changes[change]).assign(Change=change) for change in CHANGE_TYPES])
+    with _replacing(path) as tmp_path:
+        feather.write_feather(pa.Table.from_pandas(log, preserve_index=True), tmp_path, compression="uncompressed")
+
+    entry = {"release": release, "previous": previous, "recorded_at": pd.Timestamp.now("UTC").isoformat(),
+             "path": path, **{change: len(changes[change]) for change in CHANGE_TYPES}}
+    with open(f"{history_dir}/history.jsonl", "a") as f:
+        f.write(json.dumps(entry) + "\n")
+
+
+def load_change_history():
+    """
+    List the change sets recorded between successive register releases.
+
+    Returns:
+    
+        list[dict]: One entry per release, oldest first, with the 'release' and 'previous'
+                    dataset versions, 'recorded_at', 'path' and the number of rows of each change type.
+    """
+    try:
+        with open(f"{DATASTORE}/changes/history.jsonl") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def load_changes(release, previous=None):
+    """
+    Load the change set that produced a release.
+
+    Parameters:
+    
+        release (str): Dataset version of the release.
+        previous (str): Only return the change set if it was diffed against this version.
+
+    Returns:
+    
+        dict: DataFrames keyed like the output of diff_releases, or None if no change set was recorded.
+    """
+    for entry in reversed(load_change_history()):
+        if entry["release"] == release and previous in (None, entry["previous"]):
+            log = feather.read_feather(entry["path"])
+            return {change: log[log["Change"] == change].drop(columns="Change") for change in CHANGE_TYPES}
+    return None
+
+
+@metrics.timed("build_filter_index")
+def build_filter_index(df: pd.DataFrame, features=FILTER_COLUMNS):
+    """
+    Build a bitmask index over the filterable columns of the register.
+
+    Each distinct value of a feature maps to a packed bitmask of the rows holding
+    it, so a filter selection is resolved with bitwise OR/AND instead of `isin`
+    scans.
+
+    Parameters:
+    
+        df (pd.DataFrame): The preprocessed register.
+        features (list[str]): The columns to index.
+
+    Returns:
+    
+        dict: {"n_rows": int, "features": {feature: {"options": list, "masks": {value: np.ndarray}}}}
+    """
+    index = {"n_rows": len(df), "features": {}}
+    for feature in features:
+        codes, uniques = pd.factorize(df[feature])
+        masks = {value: np.packbits(codes == code) for code, value in enumerate(uniques.tolist())}
+        index["features"][feature] = {"options": list(masks), "masks": masks}
+    return index
+
+
+def filter_mask(index: dict, selections: dict):
+    """
+    Resolve a filter selection against an index from build_filter_index.
+
+    Parameters:
+    
+        index (dict): The filter index of the frame being filtered.
+        selections (dict): Mapping of feature to the selected values. Features not
+                           present are left unfiltered.
+
+    Returns:
+    
+        np.ndarray: Boolean row mask, equivalent to AND-ing `isin` over every feature.
+    """
+    n_rows = index["n_rows"]
+    packed = np.full((n_rows + 7) // 8, 0xFF, dtype=np.uint8)
+    for feature, selected in selections.items():
+        masks = index["features"][feature]["masks"]
+        feature_mask = np.zeros_like(packed)
+        for value in selected:
+            if value in masks:
+                feature_mask |= masks[value]
+        packed &= feature_mask
+    return np.unpackbits(packed, count=n_rows).view(bool)
+
+
+def _csr(keys, values, n_keys):
+    # Group `values` by integer `keys`: values of key k are values[offsets[k]:offsets[k + 1]]
+    order = np.lexsort((values, keys))
+    offsets = np.searchsorted(keys[order], np.arange(n_keys + 1))
+    return offsets, values[order]
+
+
+def _gather(offsets, values, keys):
+    # Concatenate the CSR groups of `keys` without a Python loop
+    starts = offsets[keys]
+    lengths = offsets[keys + 1] - starts
+    positions = np.arange(lengths.sum()) + np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[positions]
+
+
+def _trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@metrics.timed("build_search_index")
+def build_search_index(df: pd.DataFrame, columns=SEARCH_COLUMNS):
+    """
+    Build an inverted index over the free-text columns of the register.
+
+    Text is lower-cased and split into word tokens. Each token maps to the rows
+    holding it, and the sorted vocabulary is indexed by character trigrams for
+    fuzzy matching. Searching is then a binary search and a few array operations
+    instead of a scan over every string.
+
+    Parameters:
+    
+        df (pd.DataFrame): The register (or an archived release).
+        columns (list[str]): The columns to index.
+
+    Returns:
+    
+        dict: {"n_rows": int, "vocab": sorted token array, "offsets"/"postings": rows of each token,
+               "trigrams": {trigram: id}, "trigram_offsets"/"trigram_tokens": tokens of each trigram,
+               "token_trigrams": number of trigrams of each token}
+    """
+    positions = np.arange(len(df))
+    tokens = pd.concat([df[col].astype("string").str.lower().str.findall(r"\w+")
+                          .set_axis(positions).explode().dropna()
+                        for col in columns if col in df.columns])
+    pairs = pd.DataFrame({"row": tokens.index.to_numpy(), "token": tokens.to_numpy(dtype=object)}).drop_duplicates()
+    token_ids, vocab = pd.factorize(pairs["token"], sort=True)
+    vocab = np.asarray(vocab, dtype=object)
+    offsets, postings = _csr(token_ids, pairs["row"].to_numpy(), len(vocab))
+
+    trigram_pairs = [(trigram, token_id) for token_id, token in enumerate(vocab) for trigram in _trigrams(token)]
+    trigram_keys, trigram_tokens = (zip(*trigram_pairs) if trigram_pairs else ((), ()))
+    trigram_ids, trigrams = pd.factorize(pd.Series(trigram_keys, dtype=object))
+    trigram_offsets, trigram_tokens = _csr(trigram_ids, np.asarray(trigram_tokens, dtype=np.int64), len(trigrams))
+
+    return {"n_rows": len(df),
+            "vocab": vocab,
+            "offsets": offsets,
+            "postings": postings,
+            "trigrams": {trigram: i for i, trigram in enumerate(trigrams)},
+            "trigram_offsets": trigram_offsets,
+            "trigram_tokens": trigram_tokens,
+            "token_trigrams": np.bincount(np.asarray(trigram_tokens, dtype=np.int64), minlength=len(vocab))}
+
+
+def search_mask(index: dict, query: str, fuzzy=True, min_similarity=0.4):
+    """
+    Resolve a free-text query against an index from build_search_index.
+
+    Every word of the query must match (AND). A word matches the tokens it is a
+    prefix of and, with `fuzzy`, tokens whose trigram similarity to it is at
+    least `min_similarity`, which catches typos such as 'genration' for 'generation'.
+
+    Parameters:
+    
+        index (dict): The search index of the frame being searched.
+        query (str): The text typed by the user.
+        fuzzy (bool): Also match misspelt words.
+        min_similarity (float): Jaccard similarity of trigram sets needed for a fuzzy match.
+
+    Returns:
+    
+        np.ndarray: Boolean row mask. An empty query matches every row.
+    """
+    mask = np.ones(index["n_rows"], dtype=bool)
+    vocab = index["vocab"]
+    for term in re.findall(r"\w+", query.lower()):
+        # Tokens starting with `term` sort between it and `term` followed by the highest code point
+        start, stop = np.searchsorted(vocab, [term, term + chr(0x10FFFF)])
+        token_ids = np.arange(start, stop)
+
+        if fuzzy and len(term) >= 3:
+            term_trigrams = [index["trigrams"][t] for t in _trigrams(term) if t in index["trigrams"]]
+            if term_trigrams:
+                candidates = _gather(index["trigram_offsets"], index["trigram_tokens"], np.array(term_trigrams))
+                shared = np.bincount(candidates, minlength=len(vocab))
+                similarity = shared / (len(_trigrams(term)) + index["token_trigrams"] - shared)
+                token_ids = np.union1d(token_ids, np.flatnonzero(similarity >= min_similarity))
+
+        term_mask = np.zeros_like(mask)
+        term_mask[_gather(index["offsets"], index["postings"], token_ids)] = True
+        mask &= term_mask
+    return mask
+
+
+def release_date_from_name(name):
+    """
+    Parse the release date out of a register file name or URL such as 'tec-register-27-09-2024.csv'.
+
+    Returns:
+    
+        str: The ISO release date, or None if the name carries no date.
+    """
+    match = re.search(r"tec-register-(\d{2})-(\d{2})-(\d{4})", name)
+    return f"{match[3]}-{match[2]}-{match[1]}" if match else None
+
+
+def _connect_archive():
+    os.makedirs(DATASTORE, exist_ok=True)
+    conn = sqlite3.connect(f"{DATASTORE}/archive.sqlite")
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(releases)")]
+    if columns and columns[0] != "sha256":
+        _migrate_archive(conn)
+    conn.execute("""CREATE TABLE IF NOT EXISTS releases (
+                        sha256 TEXT PRIMARY KEY, release_date TEXT, source TEXT,
+                        rows INTEGER, ingested_at TEXT)""")
+    return conn
+
+
+def _migrate_archive(conn):
+    # Archives written before releases were keyed by their content hash held one release per date
+    with conn:
+        conn.execute("ALTER TABLE releases RENAME TO releases_by_date")
+        conn.execute("""CREATE TABLE releases (
+                            sha256 TEXT PRIMARY KEY, release_date TEXT, source TEXT,
+                            rows INTEGER, ingested_at TEXT)""")
+        conn.execute("""INSERT OR IGNORE INTO releases
+                        SELECT sha256, release_date, source, rows, ingested_at FROM releases_by_date""")
+        if conn.execute("SELECT name FROM sqlite_master WHERE name = 'register'").fetchone():
+            conn.execute('ALTER TABLE register ADD COLUMN "Release" TEXT')
+            conn.execute("""UPDATE register SET "Release" = (SELECT sha256 FROM releases_by_date
+                                                             WHERE release_date = register."Release Date")""")
+            for column, name in ARCHIVE_INDEXES.items():
+                conn.execute(f"DROP INDEX IF EXISTS idx_register_{name}")
+                conn.execute(f'CREATE INDEX idx_register_{name} ON register ("Release", "{column}")')
+        conn.execute("DROP TABLE releases_by_date")
+
+
+def ingest_release(path, release_date=None, chunksize=5000):
+    """
+    Add a register release to the archive, keyed by the hash of its contents.
+
+    Releases are never replaced: a file already archived is skipped, and
+    several releases may share a release date.
+
+    Parameters:
     
+        path (str): The release CSV.
+        release_date (str): ISO date of the release. Parsed from the file name when not given.
+        chunksize (int): Rows parsed and written per batch.
+
+    Returns:
+    
+        bool: True if the release was ingested, False if it was already archived.
+    """
+    release_date = release_date or release_date_from_name(os.path.basename(path))
+    if release_date is None:
+        raise ValueError(f"Cannot tell the release date of {path}")
+
+    with datastore_lock(), closing(_connect_archive()) as conn, conn:
+        sha256 = _file_sha256(path)
+        if conn.execute("SELECT 1 FROM releases WHERE sha256 = ?", (sha256,)).fetchone():
+            return False
+
+        rows = 0
+        quarantine_path = f"{DATASTORE}/quarantine/archive-{sha256[:16]}.csv"
+        for batch in read_register_batches(path, chunksize, quarantine_path):
+            batch.insert(0, "Release Date", release_date)
+            batch.insert(0, "Release", sha256)
+            batch.to_sql("register", conn, if_exists="append", index=False)
+            rows += len(batch)
+        for column, name in ARCHIVE_INDEXES.items():
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_register_{name} ON register ("Release", "{column}")')
+        conn.execute("INSERT INTO releases VALUES (?, ?, ?, ?, ?)",
+                     (sha256, release_date, os.path.basename(path), rows, pd.Timestamp.now("UTC").isoformat()))
+    return True
+
+
+def ingest_archive(directory=None, pattern="tec-register-*.csv"):
+    """
+    Ingest every dated register release found in a directory.
+
+    Parameters:
+    
+        directory (str): Where the release CSVs are kept. Defaults to the datastore.
+        pattern (str): Glob matching the release files.
+
+    Returns:
+    
+        list[str]: Release dates of the files that were newly ingested.
+    """
+    ingested = []
+    paths = glob(os.path.join(directory or DATASTORE, pattern))
+    for path in sorted(paths, key=lambda path: release_date_from_name(os.path.basename(path)) or ""):
+        if ingest_release(path):
+            ingested.append(release_date_from_name(os.path.basename(path)))
+    return ingested
+
+
+def list_releases():
+    """
+    List the archived releases.
+
+    Returns:
+    
+        pd.DataFrame: One row per release, oldest first, with its hash, release date, source file,
+                      row count and ingestion time.
+    """
+    with closing(_connect_archive()) as conn:
+        return pd.read_sql("SELECT * FROM releases ORDER BY release_date, ingested_at", conn)
+
+
+def query_archive(as_of=None, start=None, end=None, project=None, host_to=None, status=None,
+                  plant_type=None, columns=None, release=None):
+    """
+    Query the archive without loading every release into memory.
+
+    Pass `release` for one archived release, or `as_of` for a point-in-time view: the
+    rows of the latest release published on or before that date. Pass `start`/`end`
+    instead for every release in that range, e.g. to follow a project or a TO's
+    pipeline across releases.
+
+    Parameters:
+    
+        as_of (str): ISO date of the point-in-time view.
+        start (str): First release date of a between-releases query.
+        end (str): Last release date of a between-releases query.
+        project (str): Project ID, Project Number or exact Project Name.
+        host_to (list[str]): HOST TO values to keep.
+        status (list[str]): Project Status values to keep.
+        plant_type (list[str]): Plant Type values to keep.
+        columns (list[str]): Columns to return. Defaults to all columns.
+        release (str): sha256 of the release, as listed by list_releases.
+
+    Returns:
+    
+        pd.DataFrame: Matching preprocessed rows with their 'Release' hash and 'Release Date'.
+    """
+    where, params = [], []
+    if release is not None:
+        where.append('"Release" = ?')
+        params.append(release)
+    if as_of is not None:
+        where.append('''"Release" = (SELECT sha256 FROM releases WHERE release_date <= ?
+                                 ORDER BY release_date DESC, ingested_at DESC LIMIT 1)''')
+        params.append(str(as_of)[:10])
+    if start is not None:
+        where.append('"Release Date" >= ?')
+        params.append(str(start)[:10])
+    if end is not None:
+        where.append('"Release Date" <= ?')
+        params.append(str(end)[:10])
+    if project is not None:
+        where.append('("Project ID" = ? OR "Project Number" = ? OR "Project Name" = ?)')
+        params += [project] * 3
+    for column, values in (("HOST TO", host_to), ("Project Status", status), ("Plant Type", plant_type)):
+        if values is not None:
+            values = list(values)
+            where.append(f'"{column}" IN ({", ".join("?" * len(values))})' if values else "0")
+            params += values
+
+    select = ", ".join(f'"{column}"' for column in ["Release", "Release Date", *columns]) if columns else "*"
+    sql = (f"SELECT {select} FROM register" + (f" WHERE {' AND '.join(where)}" if where else "")
+           + ' ORDER BY "Release Date", rowid')
+    with closing(_connect_archive()) as conn:
+        if not conn.execute("SELECT name FROM sqlite_master WHERE name = 'register'").fetchone():
+            return pd.DataFrame([])
+        df = pd.read_sql(sql, conn, params=params)
+
+    if "Connection Date" in df.columns:
+        df["Connection Date"] = pd.to_datetime(df["Connection Date"], errors="coerce")
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
     return df
 
 
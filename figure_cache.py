@@ -0,0 +1,174 @@
+import contextvars
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import as_completed
+import metrics
+
+__all__ = ['FigureCache', 'figure_key', 'figure_to_json', 'render_figure_json']
+
+
+def figure_key(version, selections: dict, chart_id: str):
+    """
+    Build a cache key that does not depend on the order filters were picked in.
+
+    Parameters:
+
+        version (str): The dataset version the figure was built from.
+        selections (dict): Mapping of feature to the selected values.
+        chart_id (str): Identifier of the chart, including any chart options.
+
+    Returns:
+
+        tuple: A hashable (version, filters, chart_id) key.
+    """
+    filters = tuple(sorted((feature, tuple(sorted(map(str, values))))
+                           for feature, values in selections.items()))
+    return version, filters, chart_id
+
+
+def figure_to_json(fig):
+    """Serialize a Plotly figure the same way st.plotly_chart does."""
+    import plotly.io as pio
+    return pio.to_json(fig, validate=False)
+
+
+def render_figure_json(container, spec: str, use_container_width=True):
+    """
+    Display a pre-serialized Plotly figure without rebuilding and re-serializing it.
+
+    st.plotly_chart always validates and serializes its figure, so this fills the
+    same message with the cached spec and enqueues it on the given container.
+    Where that is not possible, the figure is rebuilt from the spec and passed to
+    st.plotly_chart instead.
+
+    Parameters:
+
+        container (DeltaGenerator): Where to draw the chart, e.g. an `st.empty()` placeholder.
+        spec (str): Figure JSON from figure_to_json.
+        use_container_width (bool): Stretch the chart to the container's width.
+    """
+    # The PlotlyChart proto layout and DeltaGenerator._enqueue are Streamlit internals,
+    # written against streamlit==1.32 (see requirements.txt); other versions may lack them
+    try:
+        from streamlit.proto.PlotlyChart_pb2 import PlotlyChart as PlotlyChartProto
+
+        proto = PlotlyChartProto()
+        proto.use_container_width = use_container_width
+        proto.figure.spec = spec
+        proto.figure.config = json.dumps({"showLink": False, "linkText": False})
+        proto.theme = "streamlit"
+        enqueue = container._enqueue
+    except (ImportError, AttributeError, ValueError, TypeError):
+        import plotly.io as pio
+        return container.plotly_chart(pio.from_json(spec, skip_invalid=True), use_container_width=use_container_width)
+    return enqueue("plotly_chart", proto)
+
+
+class FigureCache:
+    """
+    Thread-safe, size-bounded LRU cache of serialized Plotly figures.
+
+    Shared by every session of the app, so identical filter combinations from
+    different users are only built once. With another `serialize` it caches any
+    built value, e.g. the API's response bodies.
+
+    Parameters:
+
+        maxsize (int): Maximum number of figures held before the least recently used is evicted.
+        serialize (callable): Turns what `build` returns into the cached value.
+        name (str): Stage name its hits and misses are recorded under in `metrics`.
+    """
+
+    def __init__(self, maxsize=256, serialize=figure_to_json, name="figure_cache"):
+        self.maxsize = maxsize
+        self.serialize = serialize
+        self.name = name
+        self._figures = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_build(self, key, build):
+        """
+        Return the cached figure JSON for `key`, building and storing it on a miss.
+
+        Parameters:
+
+            key (tuple): Key from figure_key.
+            build (callable): Zero-argument function returning a Plotly figure.
+
+        Returns:
+
+            str: The figure JSON.
+        """
+        with self._lock:
+            if key in self._figures:
+                self._figures.move_to_end(key)
+                self.hits += 1
+                metrics.record_cache(self.name, hit=True)
+                return self._figures[key]
+            self.misses += 1
+        metrics.record_cache(self.name, hit=False)
+
+        # Build outside the lock so a slow chart does not block other sessions
+        spec = self.serialize(build())
+        self.put(key, spec)
+        return spec
+
+    def put(self, key, spec):
+        """Store an already serialized figure, e.g. one precomputed in a warm-start bundle."""
+        with self._lock:
+            self._figures[key] = spec
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.maxsize:
+                self._figures.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build_many(self, jobs: dict, executor):
+        """
+        Resolve several figures concurrently, yielding each one as soon as it is ready.
+
+        Parameters:
+
+            jobs (dict): Mapping of a name to a (key, build) pair as taken by get_or_build.
+            executor (concurrent.futures.Executor): Pool the builds run on.
+
+        Yields:
+
+            tuple: (name, figure JSON, seconds taken to fetch or build it), in completion order.
+        """
+        def timed(key, build):
+            start = time.perf_counter()
+            spec = self.get_or_build(key, build)
+            return spec, time.perf_counter() - start
+
+        # Each build runs in a copy of the caller's context, so its metrics are tagged with the caller's rerun
+        futures = {executor.submit(contextvars.copy_context().run, timed, key, build): name
+                   for name, (key, build) in jobs.items()}
+        for future in as_completed(futures):
+            spec, seconds = future.result()
+            yield futures[future], spec, seconds
+
+    def clear(self):
+        with self._lock:
+            self._figures.clear()
+
+    def stats(self):
+        """
+        Return the cache counters.
+
+        Returns:
+
+            dict: hits, misses, evictions, size, maxsize and hit_rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": len(self._figures),
+                    "maxsize": self.maxsize,
+                    "hit_rate": self.hits / lookups if lookups else 0.0}
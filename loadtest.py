@@ -0,0 +1,306 @@
+"""
+Concurrent-session load test for TECapp.py.
+
+Starts the dashboard with `streamlit run` as a single replica against a local
+stand-in for the NESO portal and drives N sessions at once over its websocket,
+speaking the same protocol as the browser. Every session opens the dashboard
+and then replays a random but realistic sequence of sidebar changes:
+transmission owners, statuses, agreement types, search text and timeline
+buckets. Each interaction is one rerun of the script, timed from sending the
+widget states to the server's script-finished message.
+
+For every concurrency level one JSON line is written with the rerun latency
+percentiles, reruns per second, figure cache hit rate and the server's resident
+memory per session:
+
+    python loadtest.py --sessions 1 2 4 8 16 --actions 20 --output load.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+import neso_stub
+
+__all__ = ['run_session', 'run_load_test']
+
+SEARCHES = ["wind", "solar", "battery", "bess", "farm", "energy storage", "offshore", "substation"]
+FILTERS = {"owner": "Trasmission Owner", "status": "Project Status", "agreement": "Agreement Type"}
+PERCENTILES = [50, 90, 95, 99]
+WIDGET_TYPES = ("multiselect", "text_input", "radio")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _rss_bytes(pid):
+    """Resident memory of process `pid`, or None where /proc is unavailable."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_totals(metrics_url, stage="figure_cache"):
+    """Hits and misses of a cache stage, scraped from the app's Prometheus endpoint."""
+    with urllib.request.urlopen(metrics_url, timeout=10) as response:
+        text = response.read().decode()
+    totals = {}
+    for field in ("hits", "misses"):
+        match = re.search(rf'^tec_stage_cache_{field}_total{{stage="{stage}"}} (\d+)', text, re.M)
+        totals[field] = int(match.group(1)) if match else 0
+    return totals
+
+
+class _Session:
+    """One browser session on the app's websocket: sends widget states and times each rerun."""
+
+    def __init__(self, connection, timeout):
+        self.connection = connection
+        self.timeout = timeout
+        self.widgets = {}   # label -> (element type, widget proto) as last rendered
+        self.states = {}    # widget id -> WidgetState sent with every rerun
+
+    async def rerun(self):
+        """Rerun the script with the current widget states, returning (seconds, exceptions shown)."""
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.widget_states.widgets.extend(self.states.values())
+        start = time.perf_counter()
+        await self.connection.write_message(message.SerializeToString(), binary=True)
+        exceptions = 0
+        while True:
+            raw = await asyncio.wait_for(self.connection.read_message(), self.timeout)
+            if raw is None:
+                raise ConnectionError("The server closed the session")
+            forward = ForwardMsg()
+            forward.ParseFromString(raw)
+            kind = forward.WhichOneof("type")
+            if kind == "script_finished":
+                return time.perf_counter() - start, exceptions
+            if kind == "delta" and forward.delta.WhichOneof("type") == "new_element":
+                element = forward.delta.new_element
+                element_type = element.WhichOneof("type")
+                if element_type == "exception":
+                    exceptions += 1
+                elif element_type in WIDGET_TYPES:
+                    widget = getattr(element, element_type)
+                    self.widgets[widget.label] = (element_type, widget)
+
+    def _set(self, label, **value):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        _, widget = self.widgets[label]
+        state = WidgetState(id=widget.id)
+        for field, data in value.items():
+            if field == "int_array_value":
+                state.int_array_value.data.extend(data)
+            else:
+                setattr(state, field, data)
+        self.states[widget.id] = state
+
+    def random_action(self, rng):
+        """Change one sidebar widget at random, returning a short description of the change."""
+        kind = rng.choice([*FILTERS, "search", "timeline", "reset"])
+        if kind in FILTERS:
+            _, widget = self.widgets[FILTERS[kind]]
+            choice = rng.sample(range(len(widget.options)), rng.randint(1, len(widget.options)))
+            self._set(FILTERS[kind], int_array_value=sorted(choice))
+            return f"{kind}={len(choice)}"
+        if kind == "search":
+            query = rng.choice(["", *SEARCHES])
+            self._set("Search projects", string_value=query)
+            return f"search={query!r}"
+        if kind == "timeline":
+            _, widget = self.widgets["Timeline buckets"]
+            index = rng.randrange(len(widget.options))
+            self._set("Timeline buckets", int_value=index)
+            return f"timeline={widget.options[index]}"
+        # Back to the defaults: every filter selected and no search
+        for label in [*FILTERS.values(), "Search projects"]:
+            self.states.pop(self.widgets[label][1].id, None)
+        return "reset"
+
+
+async def run_session(url, actions=20, seed=0, timeout=120, think=0.0):
+    """
+    Open the dashboard in one websocket session and replay random sidebar changes.
+
+    Parameters:
+
+        url (str): The app's websocket endpoint, e.g. ws://localhost:8501/_stcore/stream.
+        actions (int): Number of interactions after the first page load.
+        seed (int): Seed of the session's sequence of interactions.
+        timeout (float): Seconds a single rerun may take.
+        think (float): Seconds the session waits between interactions.
+
+    Returns:
+
+        dict: 'latencies' of every rerun in seconds (the first is the page load), 'errors' and 'actions' taken.
+    """
+    from tornado.websocket import websocket_connect
+
+    rng = random.Random(seed)
+    connection = await websocket_connect(url)
+    session = _Session(connection, timeout)
+    latencies, taken, errors = [], [], 0
+    try:
+        for step in range(actions + 1):
+            if step:
+                taken.append(session.random_action(rng))
+                await asyncio.sleep(think)
+            seconds, exceptions = await session.rerun()
+            latencies.append(seconds)
+            errors += exceptions
+    finally:
+        connection.close()
+    return {"latencies": latencies, "errors": errors, "actions": taken}
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _start_app(script, port, env, timeout):
+    app = subprocess.Popen([sys.executable, "-m", "streamlit", "run", script,
+                            f"--server.port={port}", "--server.headless=true",
+                            "--browser.gatherUsageStats=false"],
+                           env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if app.poll() is not None:
+            raise RuntimeError(f"streamlit exited with status {app.returncode}")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=1) as response:
+                if response.read() == b"ok":
+                    return app
+        except OSError:
+            time.sleep(0.2)
+    app.terminate()
+    raise TimeoutError("streamlit did not start")
+
+
+def run_load_test(source="datastore/tecregister.csv", concurrency=(1, 2, 4, 8), actions=20,
+                  latency=0.0, seed=0, timeout=120, think=0.0, script="TECapp.py"):
+    """
+    Run the load test at each concurrency level against one app server.
+
+    Parameters:
+
+        source (str): The register CSV the portal stand-in serves.
+        concurrency (iterable[int]): Numbers of simultaneous sessions to run.
+        actions (int): Interactions per session after its first page load.
+        latency (float): Seconds the portal stand-in waits before answering.
+        seed (int): Base seed of the sessions' interaction sequences.
+        timeout (float): Seconds a single rerun may take.
+        think (float): Seconds each session waits between interactions.
+        script (str): The Streamlit script to serve.
+
+    Yields:
+
+        dict: One record per concurrency level with latency percentiles, throughput and memory per session.
+    """
+    stub = neso_stub.serve(source, latency=latency)
+    datastore = tempfile.mkdtemp(prefix="tec-load-")
+    port, metrics_port = _free_port(), _free_port()
+    env = {**os.environ,
+           "TEC_REGISTER_URL": stub.register_url,
+           "TEC_PAGE_URL": stub.page_url,
+           "TEC_DATASTORE": datastore,
+           "TEC_WARMSTART": os.path.join(datastore, "no-bundle"),
+           "TEC_METRICS_PORT": str(metrics_port)}
+    url = f"ws://127.0.0.1:{port}/_stcore/stream"
+    metrics_url = f"http://127.0.0.1:{metrics_port}/metrics"
+    app = None
+    try:
+        app = _start_app(script, port, env, timeout)
+        # Load the register and start the refresher before anything is timed
+        asyncio.run(run_session(url, actions=0, timeout=timeout))
+
+        for sessions in concurrency:
+            seeds = [seed * 10007 + sessions * 101 + i for i in range(sessions)]
+
+            async def level():
+                return await asyncio.gather(*(run_session(url, actions, s, timeout, think) for s in seeds),
+                                            return_exceptions=True)
+
+            cache_before = _cache_totals(metrics_url)
+            rss_before = _rss_bytes(app.pid)
+            start = time.perf_counter()
+            results = asyncio.run(level())
+            wall = time.perf_counter() - start
+            rss_after = _rss_bytes(app.pid)
+            cache_after = _cache_totals(metrics_url)
+
+            finished = [result for result in results if isinstance(result, dict)]
+            latencies = [seconds for result in finished for seconds in result["latencies"]]
+            interactions = [seconds for result in finished for seconds in result["latencies"][1:]]
+            hits = cache_after["hits"] - cache_before["hits"]
+            lookups = hits + cache_after["misses"] - cache_before["misses"]
+            record = {"sessions": sessions,
+                      "actions_per_session": actions,
+                      "portal_latency": latency,
+                      "think_seconds": think,
+                      "reruns": len(latencies),
+                      "failed_sessions": sessions - len(finished),
+                      "errors": sum(result["errors"] for result in finished),
+                      "wall_seconds": wall,
+                      "reruns_per_second": len(latencies) / wall if wall else None,
+                      "first_load_seconds_median": statistics.median(r["latencies"][0] for r in finished) if finished else None,
+                      "figure_cache_hit_rate": hits / lookups if lookups else None,
+                      "rss_bytes": rss_after,
+                      "rss_delta_per_session_bytes": (rss_after - rss_before) / sessions if rss_after is not None else None}
+            if interactions:
+                record.update({f"rerun_seconds_p{pct}": _percentile(interactions, pct) for pct in PERCENTILES})
+                record["rerun_seconds_max"] = max(interactions)
+            failures = [repr(result) for result in results if isinstance(result, BaseException)]
+            if failures:
+                record["failures"] = sorted(set(failures))
+            yield record
+    finally:
+        if app is not None:
+            app.terminate()
+            app.wait()
+        stub.shutdown()
+        stub.server_close()
+        shutil.rmtree(datastore, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the TEC dashboard with concurrent sessions.")
+    parser.add_argument("--source", default="datastore/tecregister.csv")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--actions", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the portal stand-in waits per request")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds each session waits between interactions")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="Write JSON lines here instead of stdout")
+    args = parser.parse_args()
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for record in run_load_test(os.path.abspath(args.source), args.sessions, args.actions,
+                                    args.latency, args.seed, args.timeout, args.think):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
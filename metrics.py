@@ -0,0 +1,240 @@
+"""
+Lightweight per-stage instrumentation.
+
+Stages are timed with `timed` (decorator) or `stage` (context manager) and recorded
+with their wall time, row count, cache outcome and the process's peak memory so
+far. That peak is process-wide (ru_maxrss): it only ever rises, and a stage that
+allocates nothing new still reports the highest peak of any stage or session before it.
+Events are tagged with the session and rerun they happened in, so the dashboard
+can show a per-rerun breakdown, and the registry exports Prometheus text or JSON
+lines. Recording is a few dictionary updates under a lock, cheap enough to leave on.
+"""
+import contextvars
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+__all__ = ['MetricsRegistry', 'registry', 'stage', 'timed', 'record_cache', 'begin_rerun', 'end_rerun',
+           'end_session', 'prune_sessions', 'serve']
+
+# Session and rerun the current thread is working for; copied into chart worker threads
+_current_rerun = contextvars.ContextVar("tec_current_rerun", default=(None, None))
+
+
+def peak_rss_bytes():
+    """Peak resident memory of the whole process since it started, or None where it cannot be read cheaply."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _rows(obj):
+    shape = getattr(obj, "shape", None)
+    return shape[0] if isinstance(shape, tuple) and shape else None
+
+
+class MetricsRegistry:
+    """
+    Thread-safe store of stage timings.
+
+    Parameters:
+
+        max_events (int): Number of recent events kept for per-session views and JSON lines export.
+    """
+
+    def __init__(self, max_events=10000):
+        self._lock = threading.Lock()
+        self._events = deque(maxlen=max_events)
+        self._stages = {}
+        self._reruns = {}
+
+    def record(self, name, seconds, rows=None, cache=None):
+        """
+        Record one run of a stage.
+
+        Parameters:
+
+            name (str): Stage name.
+            seconds (float): Wall time taken.
+            rows (int): Rows produced or processed, if meaningful.
+            cache (str): 'hit' or 'miss' for cached stages.
+        """
+        session, rerun = _current_rerun.get()
+        event = {"ts": time.time(), "session": session, "rerun": rerun, "stage": name,
+                 "seconds": seconds, "rows": rows, "cache": cache,
+                 "process_peak_rss_bytes": peak_rss_bytes()}
+        with self._lock:
+            self._events.append(event)
+            totals = self._stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                    "rows": None, "hits": 0, "misses": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            if rows is not None:
+                totals["rows"] = rows
+            if cache == "hit":
+                totals["hits"] += 1
+            elif cache == "miss":
+                totals["misses"] += 1
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as stage `name`.
+
+        Yields:
+
+            dict: Set 'rows' and/or 'cache' on it to record them with the timing.
+        """
+        info = {}
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(name, time.perf_counter() - start, info.get("rows"), info.get("cache"))
+
+    def timed(self, name):
+        """
+        Decorator recording each call of the function as stage `name`.
+
+        Rows are taken from a DataFrame result, or else from a DataFrame first argument
+        (e.g. the rows a chart was built from).
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name) as info:
+                    result = func(*args, **kwargs)
+                    info["rows"] = _rows(result)
+                    if info["rows"] is None and args:
+                        info["rows"] = _rows(args[0])
+                    return result
+            return wrapper
+        return decorator
+
+    def begin_rerun(self, session):
+        """Tag the stages recorded from now on in this thread with `session` and a new rerun number."""
+        with self._lock:
+            rerun = self._reruns.get(session, 0) + 1
+            self._reruns[session] = rerun
+        _current_rerun.set((session, rerun))
+        return rerun
+
+    def end_rerun(self, seconds):
+        """Record the whole rerun's wall time as stage 'rerun'."""
+        self.record("rerun", seconds)
+
+    def end_session(self, session):
+        """Forget the rerun count of a session that has ended. Its recent events are kept."""
+        with self._lock:
+            self._reruns.pop(session, None)
+
+    def prune_sessions(self, is_active):
+        """
+        Forget the rerun counts of every session that has ended.
+
+        Parameters:
+
+            is_active (callable): Returns whether a session id is still connected.
+        """
+        with self._lock:
+            sessions = list(self._reruns)
+        for session in sessions:
+            if not is_active(session):
+                self.end_session(session)
+
+    def events(self, session=None, rerun=None):
+        """Recent events, optionally only those of one session (and rerun)."""
+        with self._lock:
+            return [event for event in self._events
+                    if (session is None or event["session"] == session)
+                    and (rerun is None or event["rerun"] == rerun)]
+
+    def stages(self):
+        """Totals per stage since the process started."""
+        with self._lock:
+            return {name: dict(totals) for name, totals in self._stages.items()}
+
+    def to_prometheus(self):
+        """Export the per-stage totals in the Prometheus text exposition format."""
+        lines = []
+        metrics = [("tec_stage_calls_total", "counter", "Number of times the stage ran", "calls"),
+                   ("tec_stage_seconds_total", "counter", "Wall time spent in the stage", "seconds"),
+                   ("tec_stage_seconds_max", "gauge", "Slowest run of the stage", "max_seconds"),
+                   ("tec_stage_rows", "gauge", "Rows handled by the last run of the stage", "rows"),
+                   ("tec_stage_cache_hits_total", "counter", "Cache hits of the stage", "hits"),
+                   ("tec_stage_cache_misses_total", "counter", "Cache misses of the stage", "misses")]
+        stages = self.stages()
+        for metric, kind, help_text, field in metrics:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            for name, totals in sorted(stages.items()):
+                if totals[field] is not None:
+                    lines.append(f'{metric}{{stage="{name}"}} {totals[field]}')
+        peak = peak_rss_bytes()
+        if peak is not None:
+            lines += ["# HELP tec_process_peak_rss_bytes Peak resident memory of the process",
+                      "# TYPE tec_process_peak_rss_bytes gauge",
+                      f"tec_process_peak_rss_bytes {peak}"]
+        return "\n".join(lines) + "\n"
+
+    def to_jsonl(self, session=None):
+        """Export recent events as JSON lines."""
+        return "".join(json.dumps(event) + "\n" for event in self.events(session))
+
+
+registry = MetricsRegistry()
+stage = registry.stage
+timed = registry.timed
+begin_rerun = registry.begin_rerun
+end_rerun = registry.end_rerun
+end_session = registry.end_session
+prune_sessions = registry.prune_sessions
+
+
+def record_cache(name, hit, seconds=0.0):
+    """Record a lookup of cache `name` as a hit or a miss."""
+    registry.record(name, seconds, cache="hit" if hit else "miss")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, content_type = registry.to_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.jsonl":
+            body, content_type = registry.to_jsonl(), "application/x-ndjson"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serve /metrics (Prometheus text) and /metrics.jsonl (recent events) on a daemon thread.
+
+    Returns:
+
+        ThreadingHTTPServer: The running server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="tec-metrics", daemon=True).start()
+    return server
@@ -0,0 +1,139 @@
+"""
+Local stand-in for the NESO data portal.
+
+Serves a TEC register CSV with ETag/Last-Modified support and a minimal register
+page carrying the <time> element scraped by `extract_last_date_updated`, so the
+refresher, benchmarks and load tests can run without touching the real portal.
+
+Run it on its own with:
+
+    python neso_stub.py --csv datastore/tecregister.csv --port 8600
+
+and point the app at it with TEC_REGISTER_URL / TEC_PAGE_URL.
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ['NesoStub', 'serve']
+
+REGISTER_PATH = "/download/tec-register.csv"
+PAGE_PATH = "/data-portal/transmission-entry-capacity-tec-register"
+
+
+class NesoStub(ThreadingHTTPServer):
+    """
+    HTTP server standing in for the register download and the register page.
+
+    Parameters:
+
+        csv_path (str): The register file to serve.
+        port (int): Port to listen on, 0 for any free port.
+        latency (float): Seconds to sleep before answering each request.
+        last_updated (str): Text served inside the page's <time> element.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, csv_path, port=0, latency=0.0, last_updated="1 day ago"):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.latency = latency
+        self.last_updated = last_updated
+        self.fail = False
+        self.requests = 0
+        self.publish(csv_path)
+
+    def publish(self, csv_path):
+        """Serve a new release from `csv_path`, changing the ETag and Last-Modified."""
+        with open(csv_path, "rb") as f:
+            body = f.read()
+        self.body = body
+        self.etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        self.last_modified = formatdate(os.path.getmtime(csv_path), usegmt=True)
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    @property
+    def register_url(self):
+        return f"{self.base_url}{REGISTER_PATH}"
+
+    @property
+    def page_url(self):
+        return f"{self.base_url}{PAGE_PATH}"
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        if server.fail:
+            self.send_error(503)
+        elif self.path == REGISTER_PATH:
+            self._send_register()
+        elif self.path == PAGE_PATH:
+            page = f"<html><body><time>{server.last_updated}</time></body></html>".encode()
+            self._send(200, page, "text/html")
+        else:
+            self.send_error(404)
+
+    def _send_register(self):
+        server = self.server
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self._send(200, server.body, "text/csv",
+                   {"ETag": server.etag, "Last-Modified": server.last_modified})
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(csv_path="datastore/tecregister.csv", port=0, latency=0.0):
+    """
+    Start a NesoStub on a daemon thread.
+
+    Parameters:
+
+        csv_path (str): The register file to serve.
+        port (int): Port to listen on, 0 for any free port.
+        latency (float): Seconds to sleep before answering each request.
+
+    Returns:
+
+        NesoStub: The running server. Call `shutdown()` to stop it.
+    """
+    server = NesoStub(csv_path, port=port, latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the NESO data portal.")
+    parser.add_argument("--csv", default="datastore/tecregister.csv")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = NesoStub(args.csv, port=args.port, latency=args.latency)
+    print(f"TEC_REGISTER_URL={stub.register_url}")
+    print(f"TEC_PAGE_URL={stub.page_url}")
+    stub.serve_forever()
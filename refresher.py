@@ -0,0 +1,169 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+import data_loader
+from data_loader import (REGISTER_URL, PAGE_URL, load_register, get_dataset_version,
+                         extract_last_date_updated, load_changes, ingest_release, get_release_date,
+                         make_read_only)
+import artist
+
+__all__ = ['RegisterSnapshot', 'RegisterRefresher']
+
+logger = logging.getLogger(__name__)
+
+RegisterSnapshot = namedtuple("RegisterSnapshot", ["version", "data", "cube", "last_updated", "refreshed_at"])
+
+
+class RegisterRefresher(threading.Thread):
+    """
+    Daemon thread that keeps the register and its last-updated text fresh.
+
+    Page renders read `snapshot`, which is swapped atomically once a new release
+    has been loaded, so they never wait on the portal. Failed polls are retried
+    after `retry_delay`, doubling up to `max_backoff`, and keep serving the
+    previous snapshot.
+    Each release is added to the archive on the refresher thread, after it is
+    being served.
+
+    Parameters:
+
+        interval (float): Seconds between successful polls.
+        register_url (str): URL of the register CSV.
+        page_url (str): URL of the register page holding the last-updated date.
+        timeout (float): Seconds to wait on each request.
+        retry_delay (float): Seconds before the first retry after a failed poll.
+        max_backoff (float): Upper bound on the wait after repeated failures.
+        filename (str): The name of the register file in the datastore.
+        last_updated (str): Last-updated text served until the portal page has been scraped,
+                            e.g. the one saved in a warm-start bundle.
+    """
+
+    def __init__(self, interval=3600, register_url=REGISTER_URL, page_url=PAGE_URL,
+                 timeout=10, retry_delay=30, max_backoff=6 * 3600, filename="tecregister.csv",
+                 last_updated="unknown, but less than 4 weeks"):
+        super().__init__(name="tec-register-refresher", daemon=True)
+        self.interval = interval
+        self.register_url = register_url
+        self.page_url = page_url
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.filename = filename
+        self.last_updated = last_updated
+        self.failures = 0
+        self._stop_event = threading.Event()
+        # Set once there is a snapshot, or once a poll has failed without one
+        self._settled = threading.Event()
+        self._snapshot = None
+
+        # Serve the copy already on disk straight away; the thread fetches the portal
+        data = load_register(url=None, filename=filename)
+        if not data.empty:
+            self._swap(data, last_updated)
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """Configure a refresher from the TEC_* environment variables; `kwargs` are passed through."""
+        return cls(interval=float(os.environ.get("TEC_REFRESH_INTERVAL", 3600)),
+                   register_url=os.environ.get("TEC_REGISTER_URL", REGISTER_URL),
+                   page_url=os.environ.get("TEC_PAGE_URL", PAGE_URL),
+                   timeout=float(os.environ.get("TEC_REFRESH_TIMEOUT", 10)),
+                   retry_delay=float(os.environ.get("TEC_RETRY_DELAY", 30)),
+                   **kwargs)
+
+    @property
+    def snapshot(self):
+        """The latest RegisterSnapshot, or None before the first successful load."""
+        return self._snapshot
+
+    def wait_ready(self, timeout=None):
+        """
+        Block until a snapshot is available, or until a poll has failed with none to serve.
+
+        Returns:
+
+            bool: Whether a snapshot is available. False on timeout or after a failed first poll,
+                  in which case later calls return straight away until a poll succeeds.
+        """
+        self._settled.wait(timeout)
+        return self._snapshot is not None
+
+    def _swap(self, data, last_updated):
+        version = get_dataset_version(self.filename)
+        current = self._snapshot
+        if current is not None and current.version == version:
+            cube = current.cube
+        else:
+            # Roll the release's change set into the previous cube when one was recorded
+            changes = load_changes(version, previous=current.version) if current is not None else None
+            cube = artist.update_cube(current.cube, changes) if changes else artist.build_cube(data)
+            make_read_only(cube)
+
+        # A single attribute assignment, so readers see either the old or the new snapshot
+        self._snapshot = RegisterSnapshot(version=version,
+                                          data=data,
+                                          cube=cube,
+                                          last_updated=last_updated,
+                                          refreshed_at=time.time())
+        self._settled.set()
+
+    def _archive(self):
+        # Keep every release in the archive; the register URL never changes, so date it by Last-Modified.
+        # Only ever called on the refresher thread: ingesting a release takes seconds, and page renders
+        # must not wait for it
+        release_date = get_release_date(self.filename) or time.strftime("%Y-%m-%d")
+        try:
+            ingest_release(f"{data_loader.DATASTORE}/{self.filename}", release_date)
+        except Exception as e:
+            logger.warning("Could not archive the TEC register release of %s: %s", release_date, e)
+
+    def refresh_once(self):
+        """
+        Poll the portal once and swap in a new snapshot if anything changed.
+
+        The register and the last-updated text are fetched separately: if the page
+        cannot be scraped, the register is still refreshed and the previous text kept.
+
+        Raises:
+
+            requests.RequestException: If the register could not be downloaded.
+        """
+        data = load_register(self.register_url, self.filename, timeout=self.timeout, raise_errors=True)
+        current = self._snapshot
+        try:
+            last_updated = extract_last_date_updated(self.page_url, timeout=self.timeout, raise_errors=True)
+        except Exception as e:
+            logger.warning("Could not scrape the TEC register's last-updated date: %s", e)
+            last_updated = current.last_updated if current is not None else self.last_updated
+
+        version = get_dataset_version(self.filename)
+        if current is None or current.version != version or current.last_updated != last_updated:
+            self._swap(data, last_updated)
+            if current is None or current.version != version:
+                self._archive()
+
+    def next_delay(self):
+        """Seconds until the next poll, backing off exponentially after failures."""
+        if not self.failures:
+            return self.interval
+        return min(self.retry_delay * 2 ** (self.failures - 1), self.max_backoff)
+
+    def run(self):
+        # The copy served since startup has not been archived yet (a no-op if it already is)
+        if self._snapshot is not None:
+            self._archive()
+        while not self._stop_event.is_set():
+            try:
+                self.refresh_once()
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                logger.warning("TEC register refresh failed (%d in a row): %s", self.failures, e)
+                # Stop page renders waiting on a register that is not coming
+                self._settled.set()
+            self._stop_event.wait(self.next_delay())
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+__all__ = ['build_sort_index', 'query_table']
+
+
+def build_sort_index(df: pd.DataFrame, columns=None):
+    """
+    Precompute the row order of the register for every sortable column.
+
+    Sorting a filtered view is then a single pass over the stored order instead
+    of a fresh sort.
+
+    Parameters:
+
+        df (pd.DataFrame): The preprocessed register.
+        columns (list[str]): Columns to index. Defaults to all columns.
+
+    Returns:
+
+        dict: {column: (row positions in ascending order with missing values last, number of non-missing values)}
+    """
+    sort_index = {}
+    for col in columns or df.columns:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            # Sort by label rather than by category code
+            values = values.astype(object)
+        order = values.reset_index(drop=True).sort_values(kind="stable", na_position="last").index.to_numpy()
+        sort_index[col] = (order, int(values.notna().sum()))
+    return sort_index
+
+
+def query_table(df: pd.DataFrame, mask=None, sort_index=None, sort_by=None, ascending=True,
+                columns=None, page=1, page_size=50):
+    """
+    Return one page of the (filtered and sorted) register.
+
+    Only the requested page and columns are materialised, so the frame sent to
+    the browser stays the same size however large the register grows.
+
+    Parameters:
+
+        df (pd.DataFrame): The preprocessed register.
+        mask (np.ndarray): Boolean row mask from the sidebar filters and search. None keeps every row.
+        sort_index (dict): Output of build_sort_index for `df`.
+        sort_by (str): Column to sort by, or None to keep register order.
+        ascending (bool): Sort direction. Missing values always sort last.
+        columns (list[str]): Columns to return. None returns all columns; an empty list none.
+        page (int): 1-based page number, clipped to the available pages.
+        page_size (int): Rows per page.
+
+    Returns:
+
+        tuple: (page DataFrame, number of matching rows, number of pages)
+    """
+    if mask is None:
+        mask = np.ones(len(df), dtype=bool)
+
+    if sort_by:
+        order, n_valid = sort_index[sort_by]
+        if not ascending:
+            order = np.concatenate([order[:n_valid][::-1], order[n_valid:]])
+        positions = order[mask[order]]
+    else:
+        positions = np.flatnonzero(mask)
+
+    total = len(positions)
+    n_pages = max(1, -(-total // page_size))
+    page = min(max(page, 1), n_pages)
+    page_positions = positions[(page - 1) * page_size:page * page_size]
+
+    page_df = df.iloc[page_positions]
+    if columns is not None:
+        page_df = page_df[columns]
+    return page_df, total, n_pages
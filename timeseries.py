@@ -0,0 +1,195 @@
+"""
+Cumulative capacity over time from per-group prefix sums.
+
+The cube is sorted by (group, connection date), where
+a group is one combination of HOST TO, Plant Type, Project Status and Agreement
+Type, and running totals of 'Connection Cap (MW)', 'MW Change' and 'Projects'
+are taken over the sorted rows. Each row's search key is
+
+    group id * span + days since the earliest connection date
+
+so every group's dates form one sorted run of a single array. "Capacity
+connected by X" and "capacity added between X and Y" for any filter selection
+are then a binary search per selected group and a difference of prefix sums,
+without regrouping the register.
+"""
+import numpy as np
+import pandas as pd
+import metrics
+from data_loader import build_filter_index, filter_mask
+
+__all__ = ['build_capacity_index', 'date_bounds', 'capacity_between', 'capacity_by', 'cumulative_series']
+
+TIMESERIES_GROUPS = ["HOST TO", "Plant Type", "Project Status", "Agreement Type"]
+VALUE_COLUMNS = ['Connection Cap (MW)', 'MW Change', 'Projects']
+
+
+def _days(dates):
+    # Whole days since the epoch, and which of them are missing
+    days = pd.to_datetime(dates).to_numpy(dtype='datetime64[D]')
+    return days.view(np.int64), np.isnat(days)
+
+
+@metrics.timed("build_capacity_index")
+def build_capacity_index(df: pd.DataFrame, groups=TIMESERIES_GROUPS):
+    """
+    Build the sorted prefix-sum arrays of the register's capacity over time.
+
+    Rows without a connection date are left out, as they never count as connected.
+
+    Parameters:
+
+        df (pd.DataFrame): Register rows or a cube from artist.build_cube.
+        groups (list[str]): The columns the totals are split by. Filter selections
+                            can only be made on these.
+
+    Returns:
+
+        dict: {"groups": DataFrame of the group labels, "filter_index": filter index of the groups,
+               "keys": sorted search keys, "starts": first position of each group, "span": int,
+               "first_day": int, "last_day": int, "sums": {column: prefix sums, one longer than keys}}
+    """
+    values = df.assign(Projects=1) if 'Projects' not in df.columns else df
+    days, undated = _days(values['Connection Date'])
+    values = values[~undated]
+    days = days[~undated]
+
+    grouped = values.groupby(list(groups), observed=True, dropna=False, sort=True)
+    group_ids = grouped.ngroup().to_numpy()
+    group_labels = grouped.size().reset_index()[list(groups)]
+
+    first_day = int(days.min()) if len(days) else 0
+    last_day = int(days.max()) if len(days) else 0
+    # One day of room either side of a group's run, so clipped queries never reach into its neighbours
+    span = last_day - first_day + 2
+    keys = group_ids.astype(np.int64) * span + (days - first_day)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    sums = {}
+    for column in VALUE_COLUMNS:
+        column_values = values[column].to_numpy(dtype=np.float64)[order]
+        sums[column] = np.concatenate([[0.0], np.cumsum(column_values)])
+
+    return {"groups": group_labels,
+            "filter_index": build_filter_index(group_labels, features=list(groups)),
+            "keys": keys,
+            "starts": np.searchsorted(keys, np.arange(len(group_labels) + 1, dtype=np.int64) * span),
+            "span": span,
+            "first_day": first_day,
+            "last_day": last_day,
+            "sums": sums}
+
+
+def date_bounds(index):
+    """The first and last connection dates in the index, as Timestamps."""
+    return tuple(pd.Timestamp(np.datetime64(index[day], 'D')) for day in ("first_day", "last_day"))
+
+
+def _selected_groups(index, selections):
+    if not selections:
+        return np.arange(len(index["groups"]))
+    return np.flatnonzero(filter_mask(index["filter_index"], selections))
+
+
+def _positions(index, group_ids, days, side):
+    # Search positions of each (group, day) pair: an array of shape (groups, days)
+    offsets = np.clip(np.asarray(days, dtype=np.int64) - index["first_day"], -1, index["span"] - 2)
+    keys = group_ids[:, None].astype(np.int64) * index["span"] + offsets[None, :]
+    return np.searchsorted(index["keys"], keys, side=side)
+
+
+def _day(date, default):
+    if date is None or pd.isna(date):
+        return default
+    return int(np.datetime64(pd.Timestamp(date), 'D').view(np.int64))
+
+
+def capacity_between(index, start=None, end=None, selections=None):
+    """
+    Total capacity of the projects connecting between two dates, both inclusive.
+
+    Parameters:
+
+        index (dict): The index from build_capacity_index.
+        start: First connection date counted, or None for no lower bound.
+        end: Last connection date counted, or None for no upper bound.
+        selections (dict): Mapping of feature to the selected values, as for the sidebar filters.
+
+    Returns:
+
+        dict: Summed 'Connection Cap (MW)', 'MW Change' and number of 'Projects'.
+    """
+    group_ids = _selected_groups(index, selections)
+    low = _positions(index, group_ids, [_day(start, index["first_day"])], 'left')[:, 0]
+    high = _positions(index, group_ids, [_day(end, index["last_day"])], 'right')[:, 0]
+    totals = {column: float((sums[high] - sums[low]).sum()) for column, sums in index["sums"].items()}
+    totals['Projects'] = int(round(totals['Projects']))
+    return totals
+
+
+def capacity_by(index, date, selections=None):
+    """
+    Total capacity of the projects connected on or before `date`.
+
+    Parameters:
+
+        index (dict): The index from build_capacity_index.
+        date: The cut-off connection date.
+        selections (dict): Mapping of feature to the selected values, as for the sidebar filters.
+
+    Returns:
+
+        dict: Summed 'Connection Cap (MW)', 'MW Change' and number of 'Projects'.
+    """
+    return capacity_between(index, None, date, selections)
+
+
+def cumulative_series(index, dates=None, selections=None, by=None, freq='ME'):
+    """
+    Running totals of capacity connected by each of a series of dates.
+
+    Parameters:
+
+        index (dict): The index from build_capacity_index.
+        dates (list): The dates to total up to. Defaults to every `freq` period end
+                      from the first to the last connection date.
+        selections (dict): Mapping of feature to the selected values, as for the sidebar filters.
+        by (str): One of the index's group columns to split the totals by, or None.
+        freq (str): Pandas frequency of the default dates.
+
+    Returns:
+
+        pd.DataFrame: 'Connection Date', the `by` column if given, and the cumulative
+                      'Connection Cap (MW)', 'MW Change' and 'Projects'.
+    """
+    if dates is None:
+        first, last = date_bounds(index)
+        dates = pd.date_range(first, last + pd.offsets.MonthEnd(0), freq=freq)
+        if not len(dates) or dates[-1] < last:
+            dates = dates.append(pd.DatetimeIndex([last]))
+    dates = pd.DatetimeIndex(dates)
+    days, _ = _days(dates)
+
+    group_ids = _selected_groups(index, selections)
+    starts = index["starts"][group_ids]
+    ends = _positions(index, group_ids, days, 'right')
+
+    if by is None:
+        labels, codes = None, np.zeros(len(group_ids), dtype=np.intp)
+    else:
+        codes, labels = pd.factorize(index["groups"][by].to_numpy()[group_ids], sort=True, use_na_sentinel=False)
+
+    n_labels = 1 if labels is None else len(labels)
+    columns = {}
+    for column, sums in index["sums"].items():
+        per_group = sums[ends] - sums[starts][:, None]
+        totals = np.zeros((n_labels, len(dates)))
+        np.add.at(totals, codes, per_group)
+        columns[column] = totals.ravel()
+    columns['Projects'] = np.rint(columns['Projects']).astype(np.int64)
+
+    series = pd.DataFrame({'Connection Date': np.tile(dates, n_labels)})
+    if labels is not None:
+        series[by] = np.repeat(labels, len(dates))
+    return series.assign(**columns)
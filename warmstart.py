@@ -0,0 +1,232 @@
+"""
+Warm-start bundles for fast replica startup.
+
+A bundle is built at deploy time and holds the fetched register with its cache
+metadata, its preprocessed Feather snapshot, the portal's last-updated text and
+the serialized figures of the dashboard's default (unfiltered) view. A new
+replica installs it into an empty datastore, so its first page is served without
+waiting on the portal, re-parsing the CSV or importing Plotly:
+
+    python warmstart.py build --output warmstart
+    TEC_WARMSTART=warmstart streamlit run TECapp.py
+
+`python warmstart.py measure` reports import and first-render times with and
+without a bundle, against a local portal stand-in.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+import data_loader
+import artist
+from data_loader import REGISTER_URL, PAGE_URL, load_register, get_dataset_version, extract_last_date_updated, build_filter_index
+from figure_cache import figure_key, figure_to_json
+from timeseries import build_capacity_index, cumulative_series
+
+__all__ = ['build_bundle', 'install_bundle', 'seed_figure_cache', 'measure_startup']
+
+MANIFEST = "bundle.json"
+# The dashboard's charts in their default state, by the chart ids TECapp.py gives them
+DEFAULT_CHARTS = {'plant_type_cap': artist.plot_plant_type_cap,
+                  'sunburst': artist.plot_sunburst,
+                  'status_host_dist': artist.plot_conn_capa_dist_by_status_host,
+                  'timelines:day': partial(artist.plot_timelines, granularity='day'),
+                  'cumulative_capacity': lambda cube: artist.plot_cumulative_capacity(
+                      cumulative_series(build_capacity_index(cube), by='HOST TO'))}
+HEAVY_MODULES = ["plotly", "bs4", "lxml", "requests"]
+
+
+def _bundle_files(filename):
+    return [filename, f"{filename}.meta.json", f"{os.path.splitext(filename)[0]}.feather"]
+
+
+def build_bundle(output="warmstart", url=REGISTER_URL, page_url=PAGE_URL, filename="tecregister.csv"):
+    """
+    Fetch the register and write a warm-start bundle for it.
+
+    Parameters:
+
+        output (str): Directory to write the bundle to. Replaced if it exists.
+        url (str): The URL to download the register from.
+        page_url (str): The register page scraped for the last-updated text.
+        filename (str): The name of the register file in the datastore.
+
+    Returns:
+
+        dict: The bundle's manifest.
+    """
+    data = load_register(url, filename)
+    version = get_dataset_version(filename)
+    cube = artist.build_cube(data)
+    selections = {feature: values["options"] for feature, values in build_filter_index(data)["features"].items()}
+    figures = [{"chart_id": chart_id, "spec": figure_to_json(plot(cube))} for chart_id, plot in DEFAULT_CHARTS.items()]
+
+    tmp_dir = f"{output}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name in _bundle_files(filename):
+        shutil.copy2(f"{data_loader.DATASTORE}/{name}", tmp_dir)
+    manifest = {"version": version,
+                "filename": filename,
+                "last_updated": extract_last_date_updated(page_url),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "selections": selections,
+                "figures": figures}
+    with open(f"{tmp_dir}/{MANIFEST}", "w") as f:
+        json.dump(manifest, f)
+
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_dir, output)
+    return manifest
+
+
+def _read_manifest(bundle):
+    try:
+        with open(f"{bundle}/{MANIFEST}") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def install_bundle(bundle="warmstart"):
+    """
+    Copy a bundle's register and snapshot into the datastore if it has never fetched one.
+
+    A datastore that already holds a fetched register is left alone, as it is at
+    least as recent as the bundle.
+
+    Parameters:
+
+        bundle (str): The bundle directory.
+
+    Returns:
+
+        dict: The bundle's manifest, or None if there is no bundle or it was not installed.
+    """
+    manifest = _read_manifest(bundle)
+    if manifest is None:
+        return None
+    filename = manifest["filename"]
+    # Replicas sharing a datastore start together, and only the first installs the bundle
+    with data_loader.datastore_lock():
+        if os.path.exists(f"{data_loader.DATASTORE}/{filename}.meta.json"):
+            return None
+        # The CSV goes last: its metadata and snapshot are then in place by the time anything reads it
+        for name in reversed(_bundle_files(filename)):
+            shutil.copy2(f"{bundle}/{name}", data_loader.DATASTORE)
+    return manifest
+
+
+def seed_figure_cache(cache, bundle="warmstart"):
+    """
+    Put a bundle's default-view figures into a FigureCache.
+
+    Parameters:
+
+        cache (FigureCache): The cache to seed.
+        bundle (str): The bundle directory.
+
+    Returns:
+
+        int: The number of figures added.
+    """
+    manifest = _read_manifest(bundle)
+    if manifest is None:
+        return 0
+    for figure in manifest["figures"]:
+        cache.put(figure_key(manifest["version"], manifest["selections"], figure["chart_id"]), figure["spec"])
+    return len(manifest["figures"])
+
+
+# Run in a fresh interpreter: time the app's imports, then its first and second render
+_MEASURE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import data_loader, artist, figure_cache, refresher, table_view, metrics
+imports = time.perf_counter() - start
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+from streamlit.testing.v1 import AppTest
+app = AppTest.from_file("TECapp.py", default_timeout=300)
+start = time.perf_counter()
+app.run()
+first_render = time.perf_counter() - start
+start = time.perf_counter()
+app.run()
+second_render = time.perf_counter() - start
+print(json.dumps({{"imports_seconds": imports, "heavy_modules_after_import": heavy,
+                  "first_render_seconds": first_render, "second_render_seconds": second_render,
+                  "exception": bool(app.exception)}}))
+"""
+
+
+def measure_startup(stub, bundle=None):
+    """
+    Measure a fresh process's import and first-render time, cold or from a bundle.
+
+    The app runs in a new interpreter with an empty datastore against a running
+    portal stand-in, answering after its configured latency.
+
+    Parameters:
+
+        stub (neso_stub.NesoStub): The portal stand-in. A bundle should have been built against it,
+                                   so the bundled register's URL is the one the app polls.
+        bundle (str): Warm-start bundle to start from, or None for a cold start.
+
+    Returns:
+
+        dict: Import, first and second render seconds and the heavy modules loaded by the imports.
+    """
+    datastore = tempfile.mkdtemp(prefix="tec-startup-")
+    try:
+        env = {**os.environ,
+               "TEC_DATASTORE": datastore,
+               "TEC_REGISTER_URL": stub.register_url,
+               "TEC_PAGE_URL": stub.page_url,
+               "TEC_WARMSTART": os.path.abspath(bundle) if bundle else os.path.join(datastore, "no-bundle")}
+        result = subprocess.run([sys.executable, "-c", _MEASURE_SCRIPT.format(heavy=HEAVY_MODULES)],
+                                env=env, capture_output=True, text=True, check=True)
+        return {"bundle": bundle, "latency": stub.latency, **json.loads(result.stdout.strip().splitlines()[-1])}
+    finally:
+        shutil.rmtree(datastore, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or measure TEC dashboard warm-start bundles.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Fetch the register and write a bundle")
+    build_parser.add_argument("--output", default=os.environ.get("TEC_WARMSTART", "warmstart"))
+    build_parser.add_argument("--url", default=os.environ.get("TEC_REGISTER_URL", REGISTER_URL))
+    build_parser.add_argument("--page-url", default=os.environ.get("TEC_PAGE_URL", PAGE_URL))
+    measure_parser = subparsers.add_parser("measure", help="Compare cold and warm-start startup times")
+    measure_parser.add_argument("--source", default="datastore/tecregister.csv")
+    measure_parser.add_argument("--latency", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        manifest = build_bundle(args.output, args.url, args.page_url)
+        print(f"Wrote {args.output} for version {manifest['version'][:16]} with {len(manifest['figures'])} figures")
+    else:
+        import neso_stub
+
+        # Bundle the register the stand-in serves, then slow it down: the warm replica polls the same
+        # live stand-in, so any portal round trip on its startup path shows up in the timings
+        stub = neso_stub.serve(args.source)
+        bundle_dir = tempfile.mkdtemp(prefix="tec-bundle-")
+        datastore = data_loader.DATASTORE
+        try:
+            data_loader.DATASTORE = os.path.join(bundle_dir, "datastore")
+            build_bundle(os.path.join(bundle_dir, "bundle"), stub.register_url, stub.page_url)
+            data_loader.DATASTORE = datastore
+            stub.latency = args.latency
+            for bundle in [None, os.path.join(bundle_dir, "bundle")]:
+                print(json.dumps(measure_startup(stub, bundle)))
+        finally:
+            data_loader.DATASTORE = datastore
+            stub.shutdown()
+            stub.server_close()
+            shutil.rmtree(bundle_dir, ignore_errors=True)